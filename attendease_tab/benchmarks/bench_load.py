@@ -0,0 +1,455 @@
+"""Simulate concurrent classrooms against a running service and report latency, errors and server load.
+
+Each simulated session posts 640x480 JPEG frames to /api/process-frame
+(base64 JSON, as the browser does) or /api/process-frame/raw. Like
+FacialRecognition.jsx, it ticks every 100 ms (--fps 10) and its
+processingRef guard skips a tick while a request is still outstanding, so a
+session is closed-loop with one request in flight; slow responses lower the
+achieved frame rate instead of piling up. The tool runs each concurrency
+level in --sessions for --duration seconds. It reports per-session latency
+percentiles, error and timeout rates, and the server's CPU and RSS
+(including detection workers) sampled over the run. The result is the
+largest session count whose p95 stays within --target-ms.
+
+Capacity numbers need --recorded footage: the synthetic scene's rectangles
+are not faces to HOG, so the real detector finds nothing and only the
+decode/gate/HOG cost is measured, not encoding, matching or tracking.
+
+By default the service is started on a free port and stopped afterwards,
+with its attendance event log and gallery cache in a temporary directory
+so simulated sessions never write "confirmed" events into the real log.
+Use --url to target one that is already running (never a production
+service: the load is recorded as attendance there); add --server-pid to
+sample its CPU and memory. Run from attendease_tab:
+
+    python benchmarks/bench_load.py --recorded lecture.mp4 --sessions 1 2 4 8 16 --duration 30
+    python benchmarks/bench_load.py --recorded lecture.mp4 --sessions 4 8 --json load.json
+    python benchmarks/bench_load.py --url http://127.0.0.1:5000 --server-pid 1234 --sessions 8
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import SyntheticScene, git_revision, load_recorded_frames, percentiles  # noqa: E402
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+SERVICE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'facial_recognition_service.py')
+JPEG_QUALITY = 80  # Matches the browser's canvas.toDataURL('image/jpeg', 0.8)
+
+
+class ProcessSampler:
+    """Background sampler of a process tree's CPU% and RSS (psutil if installed, else Linux /proc)."""
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.ticks_per_second = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    @classmethod
+    def available(cls):
+        return psutil is not None or os.path.exists('/proc/self/stat')
+
+    def _tree(self):
+        """pid plus all descendants (detection and batch worker processes)."""
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            try:
+                for task in os.listdir(f'/proc/{pid}/task'):
+                    with open(f'/proc/{pid}/task/{task}/children') as f:
+                        pending.extend(int(child) for child in f.read().split())
+            except OSError:
+                continue
+        return pids
+
+    def _read(self):
+        """Return (cpu_seconds, rss_bytes) summed over the process tree."""
+        if psutil is not None:
+            root = psutil.Process(self.pid)
+            cpu_seconds, rss = 0.0, 0
+            for process in [root] + root.children(recursive=True):
+                try:
+                    times = process.cpu_times()
+                    cpu_seconds += times.user + times.system
+                    rss += process.memory_info().rss
+                except psutil.NoSuchProcess:
+                    continue
+            return cpu_seconds, rss
+        cpu_ticks, rss_pages = 0, 0
+        for pid in self._tree():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    # The command name may contain spaces; fields after it are fixed
+                    fields = f.read().rsplit(')', 1)[1].split()
+                with open(f'/proc/{pid}/statm') as f:
+                    rss_pages += int(f.read().split()[1])
+            except OSError:
+                continue
+            cpu_ticks += int(fields[11]) + int(fields[12])
+        return cpu_ticks / self.ticks_per_second, rss_pages * self.page_size
+
+    def _run(self):
+        previous_cpu, previous_time = self._read()
+        while not self.stop_event.wait(self.interval):
+            try:
+                cpu_seconds, rss = self._read()
+            except Exception:
+                break
+            now = time.monotonic()
+            self.samples.append({
+                "t": round(now - self.started, 2),
+                "cpu_percent": round((cpu_seconds - previous_cpu) / (now - previous_time) * 100, 1),
+                "rss_mb": round(rss / 2**20, 1),
+            })
+            previous_cpu, previous_time = cpu_seconds, now
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.samples
+
+
+def summarize_samples(samples):
+    if not samples:
+        return {"cpu_percent_mean": None, "cpu_percent_max": None, "rss_mb_max": None}
+    cpu = [sample["cpu_percent"] for sample in samples]
+    return {
+        "cpu_percent_mean": round(float(np.mean(cpu)), 1),
+        "cpu_percent_max": round(float(np.max(cpu)), 1),
+        "rss_mb_max": max(sample["rss_mb"] for sample in samples),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get_status(url, path, timeout=2.0):
+    parsed = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+    try:
+        connection.request('GET', path)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def start_service(args, workdir):
+    """Launch facial_recognition_service.py on a free port and wait until /readyz passes.
+
+    The event log and gallery cache live in workdir; the real gallery cache
+    is copied there so startup does not re-encode every photo.
+    """
+    port = free_port()
+    cache_path = os.path.join(workdir, 'gallery_cache.npz')
+    real_cache = os.path.join(os.path.dirname(SERVICE_PATH), 'gallery_cache.npz')
+    if os.path.exists(real_cache):
+        shutil.copyfile(real_cache, cache_path)
+    env = dict(os.environ, PORT=str(port), LOG_LEVEL=args.server_log_level,
+               ATTENDANCE_EVENT_DB=os.path.join(workdir, 'attendance_events.db'), GALLERY_CACHE_FILE=cache_path)
+    env.pop('SHARED_GALLERY_FILE', None)
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, SERVICE_PATH], env=env, stdout=log, stderr=subprocess.STDOUT,
+                               cwd=os.path.dirname(SERVICE_PATH))
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Service exited during startup with code {process.returncode}" +
+                             (f"; see {args.server_log}" if args.server_log else "; rerun with --server-log to see why"))
+        try:
+            if get_status(url, '/readyz') == 200:
+                return process, url
+        except OSError:
+            pass
+        time.sleep(0.25)
+    process.terminate()
+    raise SystemExit(f"Service was not ready after {args.startup_timeout:.0f}s")
+
+
+def stop_service(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def encode_frames(frames, raw):
+    """JPEG-encode frames once up front so the client spends no CPU on it during the run."""
+    encoded = []
+    for frame in frames:
+        jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1].tobytes()
+        encoded.append(jpeg if raw else base64.b64encode(jpeg).decode('ascii'))
+    return encoded
+
+
+class SessionClient:
+    """One simulated classroom: posts a frame every 1/fps seconds unless max_in_flight requests are outstanding."""
+    def __init__(self, url, session_id, frames, offset, phase, args):
+        parsed = urllib.parse.urlsplit(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.session_id = session_id
+        self.frames = frames
+        self.offset = offset  # Start each session at a different frame
+        self.phase = phase  # Fraction of an interval to delay the first frame by
+        self.args = args
+        self.results = []  # (sent_at, latency_ms, outcome)
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=args.max_in_flight, thread_name_prefix=session_id)
+        self.in_flight = 0
+        self.skipped = 0  # Ticks with max_in_flight requests still outstanding (the browser skips them)
+
+    def _post(self, index, sent_at, record):
+        frame = self.frames[(self.offset + index) % len(self.frames)]
+        if self.args.endpoint == 'raw':
+            path, body = '/api/process-frame/raw', frame
+            headers = {'Content-Type': 'application/octet-stream', 'X-Session-Id': self.session_id}
+        else:
+            path = '/api/process-frame'
+            body = json.dumps({"frame": frame, "session_id": self.session_id})
+            headers = {'Content-Type': 'application/json'}
+        started = time.perf_counter()
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.args.timeout)
+        try:
+            connection.request('POST', path, body=body, headers=headers)
+            response = connection.getresponse()
+            payload = response.read()
+            if response.status != 200:
+                outcome = "error"
+            else:
+                status = json.loads(payload).get("status")
+                outcome = status if status in ("success", "dropped") else "error"
+        except socket.timeout:
+            outcome = "timeout"
+        except (OSError, http.client.HTTPException, ValueError):
+            outcome = "error"
+        finally:
+            connection.close()
+        latency_ms = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.in_flight -= 1
+            if record:
+                self.results.append((sent_at, latency_ms, outcome))
+
+    def run(self, start_at, warmup_until, stop_at):
+        interval = 1.0 / self.args.fps
+        index = 0
+        while True:
+            # Sessions are staggered across one interval so they don't fire in lockstep
+            tick = start_at + (index + self.phase) * interval
+            if tick >= stop_at:
+                break
+            delay = tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                if self.in_flight >= self.args.max_in_flight:
+                    self.skipped += tick >= warmup_until
+                    index += 1
+                    continue
+                self.in_flight += 1
+            self.pool.submit(self._post, index, tick, tick >= warmup_until)
+            index += 1
+        self.pool.shutdown(wait=True)
+
+    def report(self):
+        latencies = [latency for _, latency, outcome in self.results if outcome == "success"]
+        sent = len(self.results) + self.skipped
+        report = {
+            "session_id": self.session_id,
+            "sent": len(self.results),
+            "success": len(latencies),
+            "dropped": sum(outcome == "dropped" for _, _, outcome in self.results),
+            "errors": sum(outcome == "error" for _, _, outcome in self.results),
+            "timeouts": sum(outcome == "timeout" for _, _, outcome in self.results),
+            "not_sent": self.skipped,
+            "error_rate": round(sum(outcome in ("error", "timeout") for _, _, outcome in self.results) / sent, 4) if sent else 0.0,
+        }
+        if latencies:
+            report.update(percentiles(latencies))
+        return report
+
+
+def run_level(url, session_count, frames, args, pid):
+    clients = [SessionClient(url, f"load-{session_count}-{i}", frames, i, i / session_count, args) for i in range(session_count)]
+    sampler = ProcessSampler(pid, args.sample_interval).start() if pid and ProcessSampler.available() else None
+    start_at = time.monotonic() + 0.5
+    warmup_until = start_at + args.warmup
+    stop_at = warmup_until + args.duration
+    threads = [threading.Thread(target=client.run, args=(start_at, warmup_until, stop_at), daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    samples = sampler.stop() if sampler else []
+    # Server samples from the warmup window are kept in the series but not in the summary
+    measured = [sample for sample in samples if sample["t"] >= warmup_until - sampler.started] if sampler else []
+
+    sessions = [client.report() for client in clients]
+    latencies = [latency for client in clients for _, latency, outcome in client.results if outcome == "success"]
+    outcomes = [outcome for client in clients for _, _, outcome in client.results]
+    attempts = len(outcomes) + sum(client.skipped for client in clients)
+    result = {
+        "sessions": session_count,
+        "fps_per_session": args.fps,
+        "sent": len(outcomes),
+        "success": len(latencies),
+        "dropped_rate": round(outcomes.count("dropped") / len(outcomes), 4) if outcomes else 0.0,
+        "error_rate": round(outcomes.count("error") / attempts, 4) if attempts else 0.0,
+        "timeout_rate": round(outcomes.count("timeout") / attempts, 4) if attempts else 0.0,
+        "not_sent_rate": round(sum(client.skipped for client in clients) / attempts, 4) if attempts else 0.0,
+        "achieved_fps": round(len(latencies) / args.duration, 2),
+        "worst_session_p95_ms": max((session.get("p95_ms", 0.0) for session in sessions), default=0.0),
+        "per_session": sessions,
+        "server": summarize_samples(measured),
+        "server_samples": samples,
+    }
+    if latencies:
+        result.update(percentiles(latencies))
+    result["within_target"] = bool(
+        latencies and result["p95_ms"] <= args.target_ms and result["error_rate"] + result["timeout_rate"] <= args.max_error_rate
+    )
+    return result
+
+
+def print_results(results, args, sampled):
+    print(f"{'sessions':>8} {'sent':>6} {'ok fps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'worst p95':>10} "
+          f"{'drop %':>7} {'err %':>6} {'t/o %':>6}" + (f" {'cpu %':>7} {'max cpu':>8} {'rss MB':>8}" if sampled else "") + "  target")
+    for result in results:
+        line = (f"{result['sessions']:>8} {result['sent']:>6} {result['achieved_fps']:>7.1f} {result.get('p50_ms', float('nan')):>8.1f} "
+                f"{result.get('p95_ms', float('nan')):>8.1f} {result.get('p99_ms', float('nan')):>8.1f} {result['worst_session_p95_ms']:>10.1f} "
+                f"{result['dropped_rate'] * 100:>7.1f} {result['error_rate'] * 100:>6.1f} {result['timeout_rate'] * 100:>6.1f}")
+        if sampled:
+            server = result["server"]
+            line += "".join(f" {value:>{width}}" for value, width in (
+                (server["cpu_percent_mean"] if server["cpu_percent_mean"] is not None else "n/a", 7),
+                (server["cpu_percent_max"] if server["cpu_percent_max"] is not None else "n/a", 8),
+                (server["rss_mb_max"] if server["rss_mb_max"] is not None else "n/a", 8),
+            ))
+        print(line + ("  ok" if result["within_target"] else "  MISS"))
+        if args.per_session:
+            for session in result["per_session"]:
+                print(" " * 10 + f"{session['session_id']}: p50 {session.get('p50_ms', float('nan')):.1f}  p95 {session.get('p95_ms', float('nan')):.1f}  "
+                      f"p99 {session.get('p99_ms', float('nan')):.1f} ms, {session['errors']} errors, {session['timeouts']} timeouts")
+    passing = [result["sessions"] for result in results if result["within_target"]]
+    if passing:
+        print(f"Capacity: {max(passing)} session(s) at {args.fps:g} fps within p95 <= {args.target_ms:g} ms"
+              + ("" if args.recorded else " (synthetic scene: no faces detected, not a capacity figure)"))
+    else:
+        print(f"Capacity: no tested level stayed within p95 <= {args.target_ms:g} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8], help="concurrency levels to test, in order")
+    parser.add_argument('--fps', type=float, default=10.0, help="frame ticks per second for each session (browser: one every 100 ms)")
+    parser.add_argument('--duration', type=float, default=30.0, help="measured seconds per level")
+    parser.add_argument('--warmup', type=float, default=5.0, help="seconds per level excluded from the statistics")
+    parser.add_argument('--timeout', type=float, default=10.0, help="per-request timeout in seconds")
+    parser.add_argument('--max-in-flight', type=int, default=1, help="outstanding requests per session (the browser's processingRef allows 1)")
+    parser.add_argument('--target-ms', type=float, default=300.0, help="p95 latency a level must stay within")
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help="errors plus timeouts a level may have")
+    parser.add_argument('--endpoint', choices=['json', 'raw'], default='json', help="base64 JSON (browser) or raw JPEG bytes")
+    parser.add_argument('--faces', type=int, default=30, help="faces in the synthetic scene")
+    parser.add_argument('--frames', type=int, default=120, help="distinct frames each session cycles through")
+    parser.add_argument('--width', type=int, default=640, help="synthetic frame width (the browser's capture canvas is 640x480)")
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--recorded', metavar='PATH', help="video file or image directory to send instead of a synthetic scene")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help="target an already running service instead of starting one")
+    parser.add_argument('--server-pid', type=int, help="with --url, the service's pid for CPU/RSS sampling")
+    parser.add_argument('--server-log', metavar='PATH', help="write the started service's output here")
+    parser.add_argument('--server-log-level', default='WARNING')
+    parser.add_argument('--startup-timeout', type=float, default=300.0, help="seconds to wait for /readyz (gallery loading)")
+    parser.add_argument('--sample-interval', type=float, default=1.0, help="seconds between server CPU/RSS samples")
+    parser.add_argument('--per-session', action='store_true', help="print every session's percentiles")
+    parser.add_argument('--json', metavar='PATH', help="write results, including the CPU/RSS time series, as JSON")
+    args = parser.parse_args()
+
+    if args.recorded:
+        raw_frames = load_recorded_frames(args.recorded, args.frames)
+    else:
+        print("WARNING: no --recorded footage; HOG finds no faces in the synthetic scene, so these numbers "
+              "exclude encoding, matching and tracking and overstate capacity", file=sys.stderr)
+        scene = SyntheticScene(args.faces, args.width, args.height, args.seed)
+        raw_frames = [scene.frame(i) for i in range(args.frames)]
+    frames = encode_frames(raw_frames, args.endpoint == 'raw')
+
+    process = None
+    workdir = None
+    pid = args.server_pid
+    url = args.url
+    try:
+        if url is None:
+            workdir = tempfile.mkdtemp(prefix='bench_load-')
+            process, url = start_service(args, workdir)
+            pid = process.pid
+        if pid and not ProcessSampler.available():
+            print("Server CPU/RSS sampling needs psutil or Linux /proc; continuing without it")
+        results = []
+        for session_count in args.sessions:
+            print(f"Running {session_count} session(s) at {args.fps:g} fps for {args.warmup:g}s warmup + {args.duration:g}s...", flush=True)
+            results.append(run_level(url, session_count, frames, args, pid))
+    finally:
+        if process is not None:
+            stop_service(process)
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results, args, sampled=bool(pid and ProcessSampler.available()))
+
+    if args.json:
+        report = {
+            "meta": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "url": args.url,
+                "args": vars(args),
+            },
+            "results": results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""Replay frame sequences through the recognition pipeline and report latency, throughput and memory.
+
+Two paths are measured:
+
+  http    POST /api/process-frame/raw through the Flask test client (decode,
+          scheduling, recognition, tracking and JSON encoding)
+  stages  the inner stages called directly: resize, detect+encode
+          (detect_and_identify), match+merge (match_faces_to_trackers) and
+          serialize
+
+With --detector stub the HOG detector and encoder are replaced by ground
+truth from the synthetic scene, so tracker and matching costs can be
+measured without dlib. --detector real runs face_recognition; pair it with
+--recorded to replay a recorded video or a directory of images. Run from
+attendease_tab:
+
+    python benchmarks/bench_pipeline.py --detector stub --faces 5 30 120 --gallery 100 10000
+    python benchmarks/bench_pipeline.py --detector real --recorded recording.mp4 --json after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import facial_recognition_service as service  # noqa: E402
+from benchmarks.common import SyntheticScene, git_revision, identity_encoding, load_recorded_frames, percentiles  # noqa: E402
+
+class StubDetector:
+    """Replaces the detect/encode stages with the scene's ground truth for the current frame."""
+    def __init__(self, scene):
+        self.scene = scene
+        self.faces = []
+        self.original = dict(service.FRAME_STAGES)
+
+    def set_frame(self, index):
+        self.faces = self.scene.truth(index)
+
+    def _small_faces(self, rgb_small_frame):
+        scale = rgb_small_frame.shape[1] / self.scene.width
+        return [(identity, tuple(int(v * scale) for v in location)) for identity, location in self.faces]
+
+    def detect(self, rgb_small_frame, deduplicate=True, regions=None, upsample=1):
+        face_locations = []
+        for _, (top, right, bottom, left) in self._small_faces(rgb_small_frame):
+            if regions is not None:
+                cy, cx = (top + bottom) / 2, (left + right) / 2
+                if not any(t <= cy < b and l <= cx < r for t, r, b, l in regions):
+                    continue
+            face_locations.append((top, right, bottom, left))
+        if deduplicate:
+            face_locations = service.smooth_face_locations(face_locations)
+            face_locations = service.deduplicate_face_locations(face_locations)
+        return face_locations
+
+    def encode(self, rgb_small_frame, face_locations, landmarks="small"):
+        small_faces = self._small_faces(rgb_small_frame)
+        if not small_faces or not face_locations:
+            return np.empty((0, 128), dtype=np.float64)
+        centers = service.location_centers([location for _, location in small_faces])
+        encodings = []
+        for center in service.location_centers(face_locations):
+            nearest = int(np.argmin(np.linalg.norm(centers - center, axis=1)))
+            encodings.append(identity_encoding(small_faces[nearest][0]))
+        return np.asarray(encodings, dtype=np.float64).reshape(-1, 128)
+
+    def install(self):
+        service.FRAME_STAGES["detect"] = self.detect
+        service.FRAME_STAGES["encode"] = self.encode
+
+    def uninstall(self):
+        service.FRAME_STAGES.update(self.original)
+
+
+def build_gallery(gallery_size, face_count, seed):
+    """Enroll every scene identity plus random filler encodings up to gallery_size."""
+    rng = np.random.default_rng(seed)
+    identities = min(face_count, gallery_size)
+    encodings = [identity_encoding(i) for i in range(identities)]
+    names = [f"Student {i}" for i in range(identities)]
+    filler = gallery_size - identities
+    if filler > 0:
+        encodings.extend(rng.normal(0, 0.1, size=(filler, 128)))
+        names.extend(f"Enrolled {i}" for i in range(filler))
+    service.set_gallery(encodings, names)
+
+
+def run_http(client, frames, stub, session_id):
+    """Post each frame to /api/process-frame/raw; returns per-frame latencies in ms and the last payload."""
+    latencies = []
+    payload = None
+    for index, encoded in frames:
+        if stub is not None:
+            stub.set_frame(index)
+        started = time.perf_counter()
+        response = client.post('/api/process-frame/raw', data=encoded,
+                               headers={'Content-Type': 'application/octet-stream', 'X-Session-Id': session_id})
+        payload = response.get_json()
+        latencies.append((time.perf_counter() - started) * 1000)
+        if payload.get("status") not in ("success", "dropped"):
+            raise RuntimeError(f"Frame {index} failed: {payload.get('message')}")
+    return latencies, {}, payload
+
+
+def run_stages(frames, stub, session_id):
+    """Call the inner pipeline stages directly; returns total latencies, per-stage latencies and the last payload."""
+    session = service.TrackingSession(session_id)
+    latencies = []
+    stage_latencies = {"resize": [], "detect_encode": [], "match_merge": [], "serialize": []}
+    payload = None
+    for index, frame in frames:
+        if stub is not None:
+            stub.set_frame(index)
+        marks = [time.perf_counter()]
+        rgb_small_frame, settings = service.prepare_detection_frame(session, frame)
+        marks.append(time.perf_counter())
+        face_locations, face_encodings, assignments = service.detect_and_identify(session, rgb_small_frame, settings)
+        marks.append(time.perf_counter())
+        service.match_faces_to_trackers(session, face_locations, face_encodings, assignments, settings["factor"])
+        marks.append(time.perf_counter())
+        payload = {"status": "success", "detected_faces": service.serialize_trackers(session)}
+        service.serialize_payload(payload)
+        marks.append(time.perf_counter())
+        for stage, start, end in zip(stage_latencies, marks, marks[1:]):
+            stage_latencies[stage].append((end - start) * 1000)
+        latencies.append((marks[-1] - marks[0]) * 1000)
+    return latencies, stage_latencies, payload
+
+
+def benchmark_case(args, mode, face_count, gallery_size, client, recorded):
+    build_gallery(gallery_size, face_count, args.seed)
+    stub = None
+    if recorded is not None:
+        raw_frames = list(enumerate(recorded))
+    else:
+        scene = SyntheticScene(face_count, args.width, args.height, args.seed)
+        raw_frames = [(i, scene.frame(i)) for i in range(args.warmup + args.frames)]
+        if args.detector == "stub":
+            stub = StubDetector(scene)
+    if mode == "http":
+        frames = [(i, cv2.imencode('.jpg', frame)[1].tobytes()) for i, frame in raw_frames]
+    else:
+        frames = raw_frames
+
+    def run(session_id, selected):
+        if mode == "http":
+            return run_http(client, selected, stub, session_id)
+        return run_stages(selected, stub, session_id)
+
+    if stub is not None:
+        stub.install()
+    try:
+        case = f"{mode}-{face_count}-{gallery_size}"
+        # Warm up on a throwaway session so trackers start cold in the timed pass
+        run(f"warmup-{case}", frames[:args.warmup])
+        timed_frames = frames[args.warmup:] or frames
+        started = time.perf_counter()
+        latencies, stage_latencies, payload = run(f"bench-{case}", timed_frames)
+        elapsed = time.perf_counter() - started
+
+        # Memory is measured on a separate pass: tracemalloc slows allocation-heavy code
+        tracemalloc.start()
+        run(f"memory-{case}", timed_frames)
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        if stub is not None:
+            stub.uninstall()
+        service.set_gallery([], [])
+
+    result = {
+        "mode": mode,
+        "detector": args.detector,
+        "faces": face_count if recorded is None else None,
+        "gallery_size": gallery_size,
+        "frames": len(latencies),
+        "tracked_faces": len(payload.get("detected_faces", [])) if payload else 0,
+        "throughput_fps": round(len(latencies) / elapsed, 2),
+        "peak_traced_mb": round(peak_traced / 2**20, 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    result.update(percentiles(latencies))
+    if stage_latencies:
+        result["stages_p50_ms"] = {stage: round(float(np.percentile(values, 50)), 3) for stage, values in stage_latencies.items()}
+    return result
+
+
+def case_key(result):
+    return (result["mode"], result["detector"], result["faces"], result["gallery_size"])
+
+
+def print_results(results, baseline):
+    print(f"{'mode':>7} {'faces':>6} {'gallery':>8} {'tracked':>8} {'fps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak MB':>8}" + (f" {'p50 vs base':>12}" if baseline else ""))
+    for result in results:
+        line = (f"{result['mode']:>7} {str(result['faces']):>6} {result['gallery_size']:>8} {result['tracked_faces']:>8} "
+                f"{result['throughput_fps']:>8.1f} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['peak_traced_mb']:>8.2f}")
+        if baseline:
+            previous = baseline.get(case_key(result))
+            line += f" {(result['p50_ms'] / previous['p50_ms'] - 1) * 100:>+11.1f}%" if previous else f" {'n/a':>12}"
+        print(line)
+        if "stages_p50_ms" in result:
+            print(" " * 16 + "  ".join(f"{stage} {value:.2f}" for stage, value in result["stages_p50_ms"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['http', 'stages', 'both'], default='both')
+    parser.add_argument('--detector', choices=['stub', 'real'], default='stub')
+    parser.add_argument('--faces', type=int, nargs='+', default=[1, 10, 30, 60])
+    parser.add_argument('--gallery', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--frames', type=int, default=60, help="timed frames per case (synthetic scenes)")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--recorded', metavar='PATH', help="video file or image directory to replay instead of a synthetic scene")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH', help="write results as JSON")
+    parser.add_argument('--compare', metavar='PATH', help="baseline JSON from an earlier run to compare p50 against")
+    args = parser.parse_args()
+
+    if args.recorded and args.detector == "stub":
+        parser.error("--recorded needs --detector real: recorded frames have no ground truth for the stub")
+    # Per-frame logging would dominate the timings
+    service.logger.setLevel(logging.WARNING)
+    # The benchmark installs its own galleries; don't gate frames on (or load photos/ in) a background warmup
+    service.startup_state.skip()
+
+    recorded = load_recorded_frames(args.recorded, args.warmup + args.frames) if args.recorded else None
+    face_counts = [None] if recorded is not None else args.faces
+    modes = ['http', 'stages'] if args.mode == 'both' else [args.mode]
+    client = service.app.test_client()
+
+    results = []
+    for mode in modes:
+        for face_count in face_counts:
+            for gallery_size in args.gallery:
+                results.append(benchmark_case(args, mode, face_count or 0, gallery_size, client, recorded))
+                if recorded is not None:
+                    results[-1]["faces"] = None
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {case_key(result): result for result in json.load(f)["results"]}
+    print_results(results, baseline)
+
+    if args.json:
+        report = {
+            "meta": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "detection_workers": service.DETECTION_WORKERS,
+                "identity_caching": service.IDENTITY_CACHING,
+                "roi_detection": service.ROI_DETECTION,
+                "frame_gating": service.FRAME_GATING,
+                "quality_profile": service.DEFAULT_QUALITY_PROFILE,
+                "args": vars(args),
+            },
+            "results": results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.json}")
+
+
+if __name__ == '__main__':
+    main()
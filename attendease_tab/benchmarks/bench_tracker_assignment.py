@@ -0,0 +1,143 @@
+"""Benchmark tracker association and duplicate merging as face counts grow.
+
+Compares the previous greedy per-pair Python loops against the batched
+cost-matrix path in facial_recognition_service.py. Run from attendease_tab:
+
+    python benchmarks/bench_tracker_assignment.py --faces 10 30 60 120 240
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import facial_recognition_service as service  # noqa: E402
+
+
+def greedy_associate(face_tracker, scaled_locations):
+    """The original greedy O(detections x trackers) association loop, kept for comparison."""
+    assignments = []
+    matched_trackers = set()
+    for location in scaled_locations:
+        best_tracker = None
+        min_distance = float('inf')
+        for tracker_id, tracker in face_tracker.items():
+            if tracker_id in matched_trackers:
+                continue
+            distance = service.calculate_distance(location, tracker.location)
+            if distance < service.FACE_DISTANCE_THRESHOLD and distance < min_distance:
+                min_distance = distance
+                best_tracker = tracker_id
+        if best_tracker is not None:
+            matched_trackers.add(best_tracker)
+        assignments.append(best_tracker)
+    return assignments
+
+
+def pairwise_merge(session):
+    """The original O(n^2) scalar pairwise merge scan, kept for comparison."""
+    face_tracker = session.face_tracker
+    tracker_ids = list(face_tracker.keys())
+    merged_ids = set()
+    for i, tracker_id_1 in enumerate(tracker_ids):
+        if tracker_id_1 in merged_ids:
+            continue
+        tracker_1 = face_tracker.get(tracker_id_1)
+        if not tracker_1 or tracker_1.name == "Unknown":
+            continue
+        for tracker_id_2 in tracker_ids[i + 1:]:
+            if tracker_id_2 in merged_ids:
+                continue
+            tracker_2 = face_tracker.get(tracker_id_2)
+            if not tracker_2:
+                continue
+            if tracker_1.name == tracker_2.name:
+                distance = service.calculate_distance(tracker_1.location, tracker_2.location)
+                if distance < service.TRACKER_MERGE_THRESHOLD:
+                    conf_1 = np.mean(tracker_1.confidence_history) if tracker_1.confidence_history else 0
+                    conf_2 = np.mean(tracker_2.confidence_history) if tracker_2.confidence_history else 0
+                    if conf_1 >= conf_2:
+                        del face_tracker[tracker_id_2]
+                        merged_ids.add(tracker_id_2)
+                    else:
+                        del face_tracker[tracker_id_1]
+                        merged_ids.add(tracker_id_1)
+                        break
+
+
+def make_scene(face_count, rng, spacing=45, jitter=20, duplicate_every=0):
+    """Lecture-hall grid of trackers plus jittered detections of the same faces.
+
+    With duplicate_every=k, every k-th tracker reuses its neighbour's name so
+    the merge pass has same-name pairs to resolve.
+    """
+    columns = int(np.ceil(np.sqrt(face_count * 16 / 9)))
+    session = service.TrackingSession("bench")
+    detections = []
+    for i in range(face_count):
+        row, col = divmod(i, columns)
+        top, left = 40 + row * spacing, 40 + col * spacing
+        location = (top, left + 40, top + 40, left)
+        name_index = i - 1 if duplicate_every and i % duplicate_every == 0 and i > 0 else i
+        session.face_tracker.add(i, f"Student {name_index}", location)
+        dy, dx = rng.integers(-jitter, jitter + 1, size=2)
+        detections.append((top + dy, left + 48 + dx, top + 48 + dy, left + dx))
+    order = rng.permutation(face_count)
+    return session, [detections[i] for i in order], order
+
+
+def time_call(fn, repeats):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+def time_merge(merge, face_count, rng, repeats):
+    sessions = [make_scene(face_count, rng, duplicate_every=4)[0] for _ in range(repeats)]
+    started = time.perf_counter()
+    for session in sessions:
+        merge(session)
+    elapsed = time.perf_counter() - started
+    return elapsed / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--faces', type=int, nargs='+', default=[10, 30, 60, 120, 240])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    # Merges are logged at DEBUG; keep them out of the timings when LOG_LEVEL=DEBUG
+    service.logger.setLevel(logging.WARNING)
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'faces':>6} {'greedy assoc ms':>16} {'batched assoc ms':>17} {'greedy swaps':>13} {'batched swaps':>14} {'greedy merge ms':>16} {'batched merge ms':>17}")
+    for face_count in args.faces:
+        session, detections, truth = make_scene(face_count, rng)
+
+        greedy_ms = time_call(lambda: greedy_associate(session.face_tracker, detections), args.repeats)
+        batched_ms = time_call(lambda: service.associate_detections(session.face_tracker, detections), args.repeats)
+        # An "ID swap" is a detection handed to some other face's tracker
+        greedy_swaps = int(np.sum(np.array(greedy_associate(session.face_tracker, detections), dtype=object) != truth))
+        batched_swaps = int(np.sum(np.array(service.associate_detections(session.face_tracker, detections), dtype=object) != truth))
+
+        # Merging mutates its session, so each timed call gets a fresh scene with duplicate names
+        greedy_merge_ms = time_merge(pairwise_merge, face_count, rng, args.repeats)
+        batched_merge_ms = time_merge(service.merge_duplicate_trackers, face_count, rng, args.repeats)
+        remaining = {}
+        for label, merge in (("pairwise", pairwise_merge), ("batched", service.merge_duplicate_trackers)):
+            merge_session = make_scene(face_count, np.random.default_rng(args.seed), duplicate_every=4)[0]
+            merge(merge_session)
+            remaining[label] = sorted(merge_session.face_tracker)
+        assert remaining["pairwise"] == remaining["batched"], "merge results diverged"
+
+        print(f"{face_count:>6} {greedy_ms:>16.2f} {batched_ms:>17.2f} {greedy_swaps:>13} {batched_swaps:>14} {greedy_merge_ms:>16.2f} {batched_merge_ms:>17.2f}")
+
+
+if __name__ == '__main__':
+    main()
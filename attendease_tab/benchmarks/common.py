@@ -0,0 +1,91 @@
+"""Frame sources and reporting helpers shared by the benchmarks.
+
+Nothing here imports facial_recognition_service, so client-side tools can
+generate frames without loading the service in their own process.
+"""
+import os
+import subprocess
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class SyntheticScene:
+    """A lecture-hall grid of faces drifting slowly, with ground truth per frame.
+
+    Faces are drawn as filled squares so encoded frames have realistic
+    content to decode; the stub detector reads positions from truth instead.
+    """
+    def __init__(self, face_count, width, height, seed):
+        self.width, self.height = width, height
+        rng = np.random.default_rng(seed)
+        columns = max(1, int(np.ceil(np.sqrt(face_count * width / height))))
+        rows = max(1, int(np.ceil(face_count / columns)))
+        cell = min(width / columns, height / rows)
+        self.size = int(min(96, cell * 0.6))
+        self.origins = np.array([(row * cell + cell * 0.2, col * cell + cell * 0.2) for row, col in (divmod(i, columns) for i in range(face_count))])
+        self.phases = rng.uniform(0, 2 * np.pi, size=(face_count, 2))
+        self.colors = rng.integers(60, 230, size=(face_count, 3))
+
+    def truth(self, index):
+        """Return [(identity, (top, right, bottom, left))] in full-frame pixels for frame index."""
+        drift = 8 * np.sin(index / 6 + self.phases)
+        faces = []
+        for identity, ((y, x), (dy, dx)) in enumerate(zip(self.origins, drift)):
+            top, left = int(y + dy), int(x + dx)
+            faces.append((identity, (top, left + self.size, top + self.size, left)))
+        return faces
+
+    def frame(self, index):
+        image = np.full((self.height, self.width, 3), 90, np.uint8)
+        for identity, (top, right, bottom, left) in self.truth(index):
+            cv2.rectangle(image, (left, top), (right, bottom), [int(c) for c in self.colors[identity]], cv2.FILLED)
+        return image
+
+
+def identity_encoding(identity):
+    return np.random.default_rng(1_000_003 + identity).normal(0, 0.1, 128)
+
+
+def load_recorded_frames(path, limit):
+    """Read up to limit frames from a video file or a directory of images."""
+    frames = []
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                frame = cv2.imread(os.path.join(path, filename))
+                if frame is not None:
+                    frames.append(frame)
+            if len(frames) >= limit:
+                break
+    else:
+        capture = cv2.VideoCapture(path)
+        while len(frames) < limit:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            frames.append(frame)
+        capture.release()
+    if not frames:
+        raise SystemExit(f"No frames could be read from {path}")
+    return frames
+
+
+def percentiles(values):
+    values = np.asarray(values)
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "mean_ms": round(float(values.mean()), 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
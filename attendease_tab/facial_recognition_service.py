@@ -1,22 +1,91 @@
-import face_recognition
+import time
+
+PROCESS_STARTED = time.time()  # Reference point for startup timings
+
 import cv2
 import numpy as np
 import base64
-import time
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from scipy.optimize import linear_sum_assignment
 import os
+import sys
+import argparse
+import uuid
+import json
+import hashlib
+import sqlite3
+import atexit
+import logging
+import threading
+import weakref
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+try:
+    import fcntl
+except ImportError:  # Windows: shared gallery publishing is not serialized across workers
+    fcntl = None
+
+try:
+    from flask_sock import Sock
+except ImportError:  # WebSocket streaming is optional
+    Sock = None
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()  # DEBUG adds per-frame and per-tracker lines
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # "text" or "json" (one object per line)
+
+class JsonLogFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including any extra= fields."""
+    RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in self.RESERVED})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging():
+    """Attach a stderr handler to the service logger at LOG_LEVEL."""
+    logger = logging.getLogger("facial_recognition")
+    logger.setLevel(LOG_LEVEL)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        if LOG_FORMAT == "json":
+            handler.setFormatter(JsonLogFormatter())
+        else:
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    return logger
+
+logger = configure_logging()
 
 app = Flask(__name__)
 CORS(app)
+sock = Sock(app) if Sock else None
 
 # Global variables
-video_capture = None
-camera_on = False
-known_face_encodings = []
+face_recognition = None  # Imported on first use by load_face_recognition(); pulling in dlib and its models takes seconds
+face_recognition_lock = threading.Lock()
+camera_stream = None  # CameraStream for the opened server-side camera
+camera_stream_lock = threading.Lock()
+known_face_encodings = np.empty((0, 128), dtype=np.float32)  # Contiguous (N, 128) gallery matrix
 known_face_names = []
-face_tracker = {}
-next_face_id = 0
+gallery_entries = None  # filename -> cached photo entry from the last gallery load
+gallery_reload_lock = threading.Lock()
+tracking_sessions = {}  # session_id -> TrackingSession
+tracking_sessions_lock = threading.Lock()
 
 # Configuration
 TRACKING_THRESHOLD = 0.6  # Increased from 0.5 to 0.6 for better matching
@@ -32,106 +101,937 @@ SMOOTHING_DISTANCE_THRESHOLD = 90
 MAX_TRACKING_VELOCITY = 50
 PREDICTION_DECAY = 0.65
 RAPID_MOVEMENT_THRESHOLD = 60
-frame_count = 0
-process_frame_count = 0  # For /api/process-frame endpoint
+CONFIDENCE_WINDOW = 5  # Recent match confidences kept per tracker
+CONFIRMATION_MIN_MATCHES = 3
+CONFIRMATION_CONFIDENCE = 0.45  # Every confidence in the window must exceed this to confirm
+TRACKER_STORE_CAPACITY = 16  # Initial rows per session; doubles as needed
+ATTENDANCE_EVENT_DB = os.environ.get('ATTENDANCE_EVENT_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attendance_events.db'))
+EVENT_FLUSH_INTERVAL = 1.0  # Seconds between batched event-log writes
+EVENT_FLUSH_BATCH = 50  # Flush early once this many events are pending
+EVENT_FETCH_LIMIT = 500  # Most events returned per poll
+PHOTOS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'photos')
+GALLERY_WATCH_INTERVAL = float(os.environ.get('GALLERY_WATCH_INTERVAL', 0))  # Seconds between photos/ checks; 0 disables the watcher
+GALLERY_ADMIN_TOKEN = os.environ.get('GALLERY_ADMIN_TOKEN')  # If set, /api/gallery/reload requires it in X-Admin-Token
+SHARED_GALLERY_FILE = os.environ.get('SHARED_GALLERY_FILE')  # Memory-mapped gallery shared by worker processes; unset = per-process gallery
+SHARED_GALLERY_POLL_INTERVAL = 2.0  # Seconds between checks for a newly published shared gallery
+SHARED_GALLERY_MAGIC = b"ATTENDEASE-GALLERY-1\n"
+SHARED_GALLERY_ALIGNMENT = 64
+GALLERY_CACHE_FILE = os.environ.get('GALLERY_CACHE_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gallery_cache.npz'))
+GALLERY_CACHE_VERSION = 1
+GALLERY_INDEX_MODE = os.environ.get('GALLERY_INDEX_MODE', 'auto')  # "brute", "ivf" or "auto"
+GALLERY_INDEX_AUTO_THRESHOLD = 10000  # Switch "auto" to IVF at this many enrolled faces
+GALLERY_INDEX_NPROBE = int(os.environ.get('GALLERY_INDEX_NPROBE', 8))  # Lists scanned per query; higher = better recall
+GALLERY_RECALL_SAMPLE_SIZE = 200
+ROSTER_CACHE_SIZE = int(os.environ.get('ROSTER_CACHE_SIZE', 64))  # Course sub-galleries kept; least recently used are evicted
+DEFAULT_SESSION_ID = "default"
+CAMERA_SESSION_ID = "server-camera"
+SESSION_IDLE_TIMEOUT = 600  # Seconds without frames before a session's trackers are evicted
+MIN_FRAME_INTERVAL_MS = 100  # Floor for the send interval recommended to clients
+PROCESSING_TIME_SMOOTHING = 0.2  # EMA weight of the newest frame's processing time
+DETECTION_WORKERS = int(os.environ.get('DETECTION_WORKERS', 0))  # 0 = detect/encode inline in the request thread
+IDENTITY_CACHING = os.environ.get('IDENTITY_CACHING', '1') != '0'  # Skip re-encoding confirmed faces between verifications
+REVERIFY_INTERVAL_FRAMES = 15  # Re-encode a confirmed face at least this often
+REVERIFY_JUMP_DISTANCE = 80  # Re-encode when a confirmed face's box jumps this far (full-frame px)
+ASSIGNMENT_IOU_WEIGHT = 0.5  # How much box overlap discounts the center-distance assignment cost
+ROI_DETECTION = os.environ.get('ROI_DETECTION', '1') != '0'  # Detect only around predicted tracker boxes between sweeps
+ROI_PADDING = 1.0  # Pad each predicted box by this fraction of its size on every side
+ROI_FULL_SWEEP_INTERVAL = 10  # Force a full-frame sweep at least every N detection frames
+ROI_MOTION_PIXEL_DELTA = 12  # Gray-level change that marks a thumbnail cell as moving
+ROI_MOTION_TRIGGER = 0.005  # Fraction of moving cells outside tracker regions that forces a full sweep
+THUMBNAIL_SIZE = (32, 24)
+FRAME_GATING = os.environ.get('FRAME_GATING', '1') != '0'  # Skip detection while the scene matches the last detected frame
+FRAME_GATE_CHANGE_RATIO = 0.002  # Largest fraction of changed thumbnail cells that still counts as an unchanged scene
+FRAME_GATE_MAX_SKIPS = 20  # Detect anyway after this many consecutive skipped frames
+CAMERA_DETECTION_INTERVAL = 3  # Run recognition on every Nth captured camera frame
+CAMERA_JPEG_QUALITY = 80
+CAMERA_READ_RETRY_DELAY = 0.05  # Seconds to wait after a failed camera read
+CAMERA_MAX_READ_FAILURES = 100  # Stop the capture loop after this many consecutive failed reads
+CAMERA_STREAM_WAIT_TIMEOUT = 5.0  # Seconds a viewer waits for a new frame before giving up
+CAMERA_PROBE_INDICES = 10  # Device indices probed when scanning for cameras
+CAMERA_REGISTRY_TTL = 60  # Seconds before the cached camera list is refreshed in the background
+BATCH_MEDIA_DIR = os.environ.get('BATCH_MEDIA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings'))  # Endpoint jobs may only read below this directory
+BATCH_SAMPLE_FPS = 2.0  # Frames per second of recording analysed in batch mode
+BATCH_CHUNK_SECONDS = 120  # Recording length handled by one batch worker task
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+BATCH_QUALITY_PROFILE = "balanced"
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+PIPELINE_STAGES = ("decode", "resize", "gate", "hog", "encode", "match", "merge", "serialize")
+STAGE_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # Seconds
+QUALITY_PROFILES = {
+    "fast": {"scale": 0.2, "upsample": 0, "landmarks": "small"},
+    "balanced": {"scale": 0.25, "upsample": 1, "landmarks": "small"},
+    "accurate": {"scale": 0.5, "upsample": 1, "landmarks": "large"},
+}
+QUALITY_PROFILE_ORDER = ["fast", "balanced", "accurate"]
+DEFAULT_QUALITY_PROFILE = os.environ.get('QUALITY_PROFILE', 'auto')  # A profile name, or "auto" to adapt between them
+FRAME_LATENCY_BUDGET_MS = float(os.environ.get('FRAME_LATENCY_BUDGET_MS', 150))  # Detect+encode time the controller aims for
+HOG_MIN_FACE_PX = 80  # dlib's HOG window; each upsample halves the smallest detectable face
+FACE_SIZE_MARGIN = 1.3  # Keep the smallest tracked face this much above the detectable minimum
+MIN_DETECTION_SCALE = 0.1
+QUALITY_PROBE_INTERVAL = 30  # Detection frames between full profile-scale frames, so faces smaller than the tracked ones are still found
+QUALITY_STEP_DOWN_FRAMES = 5  # Consecutive over-budget frames before dropping a profile
+QUALITY_STEP_UP_FRAMES = 20  # Consecutive frames under half the budget before raising a profile
 
 class FaceTracker:
-    def __init__(self, face_id, name, location, encoding=None):
-        location = tuple(int(v) for v in location)
+    """One tracked face: its identity, plus a view onto its row in the session's TrackerStore."""
+    __slots__ = ("store", "row", "id", "name", "encoding", "reported_name")
+
+    def __init__(self, store, row, face_id, name, encoding=None):
+        self.store = store
+        self.row = row
         self.id = face_id
         self.name = name
-        self.location = location
-        self.raw_location = location
         self.encoding = encoding
-        self.last_seen = time.time()
-        self.confidence_history = []
-        self.missed_frames = 0
-        self.is_confirmed = False
-        self.velocity = (0.0, 0.0)
+        self.reported_name = None  # Name last announced as a "confirmed" attendance event
 
-    @staticmethod
-    def _center(location):
-        return ((location[1] + location[3]) / 2.0, (location[0] + location[2]) / 2.0)
+    @property
+    def location(self):
+        return tuple(self.store.boxes[self.row].tolist())
 
-    def _smooth_location(self, new_location):
-        if self.location is None:
-            return tuple(int(v) for v in new_location)
-        return tuple(int(self.location[i] * (1 - LOCATION_SMOOTHING_FACTOR) + new_location[i] * LOCATION_SMOOTHING_FACTOR) for i in range(4))
+    @property
+    def missed_frames(self):
+        return int(self.store.missed[self.row])
 
-    def _apply_velocity_prediction(self):
-        if self.location is None:
-            return
-        dx, dy = self.velocity
-        speed = np.sqrt(dx**2 + dy**2)
-        if speed > MAX_TRACKING_VELOCITY:
-            scale = MAX_TRACKING_VELOCITY / speed
-            self.velocity = (dx * scale, dy * scale)
-            dx, dy = self.velocity
-        if speed > RAPID_MOVEMENT_THRESHOLD:
-            self.velocity = (dx * 0.75, dy * 0.75)
-            dx, dy = self.velocity
-        if abs(dx) < 0.1 and abs(dy) < 0.1:
-            return
-        shift_x = dx * PREDICTION_DECAY
-        shift_y = dy * PREDICTION_DECAY
-        top, right, bottom, left = self.location
-        predicted = (
-            int(top + shift_y),
-            int(right + shift_x),
-            int(bottom + shift_y),
-            int(left + shift_x)
-        )
-        self.location = predicted
-        self.raw_location = predicted
-        self.velocity = (dx * PREDICTION_DECAY, dy * PREDICTION_DECAY)
+    @property
+    def is_confirmed(self):
+        return bool(self.store.confirmed[self.row])
+
+    @property
+    def frames_since_verified(self):
+        return int(self.store.frames_since_verified[self.row])
+
+    @frames_since_verified.setter
+    def frames_since_verified(self, value):
+        self.store.frames_since_verified[self.row] = value
+
+    @property
+    def confidence_history(self):
+        """Recent match confidences, oldest first."""
+        count = int(self.store.confidence_count[self.row])
+        window = self.store.confidences[self.row]
+        if count <= CONFIDENCE_WINDOW:
+            return window[:count].tolist()
+        head = count % CONFIDENCE_WINDOW
+        return np.concatenate((window[head:], window[:head])).tolist()
+
+    def mean_confidence(self):
+        """Mean of the recent confidences, or 0.0 before the first identification."""
+        return float(self.store.mean_confidences(np.array([self.row]))[0])
 
     def update_location(self, new_location, confidence=None, encoding=None):
-        new_location = tuple(int(v) for v in new_location)
-        prev_center = self._center(self.location) if self.location is not None else None
-        smoothed_location = self._smooth_location(new_location)
-        self.raw_location = new_location
-        self.location = smoothed_location
-        if prev_center is not None:
-            new_center = self._center(smoothed_location)
-            self.velocity = (new_center[0] - prev_center[0], new_center[1] - prev_center[1])
-        else:
-            self.velocity = (0.0, 0.0)
-        self.last_seen = time.time()
-        self.missed_frames = 0
         if encoding is not None:
             self.encoding = encoding
-        if confidence is not None:
-            self.confidence_history.append(confidence)
-            if len(self.confidence_history) > 5:
-                self.confidence_history.pop(0)
-            if len(self.confidence_history) >= 3 and all(c > 0.45 for c in self.confidence_history):
-                self.is_confirmed = True
-
-    def increment_missed_frames(self):
-        self.missed_frames += 1
-        self._apply_velocity_prediction()
+        self.store.update(np.array([self.row]), [new_location], [confidence])
 
     def is_expired(self):
         return self.missed_frames > TRACKING_FRAMES
 
-def load_reference_data():
-    """Load reference images and extract face encodings."""
-    global known_face_encodings, known_face_names
-    
-    known_face_encodings = []
-    known_face_names = []
-    
-    # Get the path to the photos directory (now local to this folder)
-    photos_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'photos')
-    
-    print("📸 Loading reference images...")
-    print(f"   Photos directory: {photos_dir}")
-    print(f"   Directory exists: {os.path.exists(photos_dir)}")
-    
-    # Dynamically scan the photos directory for all image files
+    def can_reuse_identity(self, new_location):
+        """True if a detection at new_location can keep this tracker's name without re-encoding."""
+        return (
+            self.is_confirmed
+            and self.name != "Unknown"
+            and self.frames_since_verified < REVERIFY_INTERVAL_FRAMES
+            and calculate_distance(new_location, self.location) < REVERIFY_JUMP_DISTANCE
+        )
+
+class TrackerStore:
+    """A session's trackers, keyed by tracker id like a dict, with their state in NumPy columns.
+
+    Boxes, velocities, miss counts and a ring buffer of the last
+    CONFIDENCE_WINDOW confidences hold one row per tracker, so smoothing,
+    velocity prediction, expiry and confidence averages run across every
+    tracker in one pass. Methods take an array of rows (see rows()); None
+    means every tracker, and results follow insertion order like a dict.
+    Removing a tracker moves the last row into its slot.
+    """
+    COLUMNS = ("boxes", "raw_boxes", "velocities", "missed", "frames_since_verified",
+               "last_seen", "confirmed", "confidences", "confidence_count")
+
+    def __init__(self, capacity=TRACKER_STORE_CAPACITY):
+        self._trackers = {}  # id -> FaceTracker, in insertion order
+        self._views = []  # row -> FaceTracker
+        self.boxes = np.zeros((capacity, 4), dtype=np.int64)  # Smoothed (top, right, bottom, left)
+        self.raw_boxes = np.zeros((capacity, 4), dtype=np.int64)  # Last detected or predicted box
+        self.velocities = np.zeros((capacity, 2))  # Center (dx, dy) per frame
+        self.missed = np.zeros(capacity, dtype=np.int64)
+        self.frames_since_verified = np.zeros(capacity, dtype=np.int64)
+        self.last_seen = np.zeros(capacity)
+        self.confirmed = np.zeros(capacity, dtype=bool)
+        self.confidences = np.zeros((capacity, CONFIDENCE_WINDOW))
+        self.confidence_count = np.zeros(capacity, dtype=np.int64)  # Total ever recorded; next slot is count % window
+
+    def __len__(self):
+        return len(self._trackers)
+
+    def __iter__(self):
+        return iter(self._trackers)
+
+    def __contains__(self, face_id):
+        return face_id in self._trackers
+
+    def __getitem__(self, face_id):
+        return self._trackers[face_id]
+
+    def get(self, face_id, default=None):
+        return self._trackers.get(face_id, default)
+
+    def keys(self):
+        return self._trackers.keys()
+
+    def values(self):
+        return self._trackers.values()
+
+    def items(self):
+        return self._trackers.items()
+
+    def add(self, face_id, name, location, encoding=None):
+        """Start tracking a new face at location and return its FaceTracker."""
+        row = len(self._views)
+        if row == len(self.missed):
+            self._grow()
+        tracker = FaceTracker(self, row, face_id, name, encoding)
+        self._views.append(tracker)
+        self._trackers[face_id] = tracker
+        self.boxes[row] = self.raw_boxes[row] = [int(v) for v in location]
+        self.velocities[row] = 0.0
+        self.missed[row] = 0
+        self.frames_since_verified[row] = 0
+        self.last_seen[row] = time.time()
+        self.confirmed[row] = False
+        self.confidence_count[row] = 0
+        return tracker
+
+    def _grow(self):
+        for column in self.COLUMNS:
+            values = getattr(self, column)
+            grown = np.zeros((len(values) * 2,) + values.shape[1:], dtype=values.dtype)
+            grown[:len(values)] = values
+            setattr(self, column, grown)
+
+    def __delitem__(self, face_id):
+        tracker = self._trackers.pop(face_id)
+        row, last = tracker.row, len(self._views) - 1
+        if row != last:
+            for column in self.COLUMNS:
+                values = getattr(self, column)
+                values[row] = values[last]
+            moved = self._views[last]
+            moved.row = row
+            self._views[row] = moved
+        self._views.pop()
+
+    def clear(self):
+        self._trackers.clear()
+        self._views.clear()
+
+    def rows(self, face_ids=None):
+        """Row indices for face_ids (default: every tracker, in insertion order)."""
+        trackers = self._trackers.values() if face_ids is None else (self._trackers[face_id] for face_id in face_ids)
+        return np.fromiter((tracker.row for tracker in trackers), dtype=np.intp)
+
+    def _all(self, rows):
+        # Updates don't depend on order, so skip the id walk that rows() needs
+        return np.arange(len(self._views)) if rows is None else rows
+
+    def update(self, rows, locations, confidences=None):
+        """Smooth matched trackers toward their detections and record any new confidences.
+
+        confidences, if given, is aligned with rows; None entries (cached
+        identities) leave the tracker's confidence window untouched.
+        """
+        new_boxes = np.asarray(locations, dtype=np.float64).reshape(-1, 4).astype(np.int64)
+        previous = self.boxes[rows]
+        smoothed = (previous * (1 - LOCATION_SMOOTHING_FACTOR) + new_boxes * LOCATION_SMOOTHING_FACTOR).astype(np.int64)
+        self.velocities[rows] = self._centers(smoothed) - self._centers(previous)
+        self.raw_boxes[rows] = new_boxes
+        self.boxes[rows] = smoothed
+        self.last_seen[rows] = time.time()
+        self.missed[rows] = 0
+        if confidences is None:
+            return
+        scores = np.array([np.nan if c is None else c for c in confidences], dtype=np.float64)
+        scored = rows[~np.isnan(scores)]
+        if len(scored) == 0:
+            return
+        self.confidences[scored, self.confidence_count[scored] % CONFIDENCE_WINDOW] = scores[~np.isnan(scores)]
+        self.confidence_count[scored] += 1
+        filled = np.minimum(self.confidence_count[scored], CONFIDENCE_WINDOW)
+        in_window = np.arange(CONFIDENCE_WINDOW)[None, :] < filled[:, None]
+        confident = ((self.confidences[scored] > CONFIRMATION_CONFIDENCE) | ~in_window).all(axis=1)
+        self.confirmed[scored] |= (filled >= CONFIRMATION_MIN_MATCHES) & confident
+
+    @staticmethod
+    def _centers(boxes):
+        return np.stack(((boxes[:, 1] + boxes[:, 3]) / 2.0, (boxes[:, 0] + boxes[:, 2]) / 2.0), axis=1)
+
+    def _predict(self, rows):
+        """Return (boxes, velocities, moving) one prediction step ahead, without mutating anything."""
+        velocities = self.velocities[rows]
+        speeds = np.sqrt((velocities ** 2).sum(axis=1))
+        clamped = speeds > MAX_TRACKING_VELOCITY
+        velocities[clamped] *= (MAX_TRACKING_VELOCITY / speeds[clamped])[:, None]
+        velocities[speeds > RAPID_MOVEMENT_THRESHOLD] *= 0.75
+        # Near-stationary faces keep their box; everyone else drifts along a decaying velocity
+        moving = (np.abs(velocities) >= 0.1).any(axis=1)
+        boxes = self.boxes[rows]
+        shifts = velocities[moving] * PREDICTION_DECAY
+        boxes[moving] = (boxes[moving] + shifts[:, [1, 0, 1, 0]]).astype(np.int64)
+        velocities[moving] = shifts
+        return boxes, velocities, moving
+
+    def predicted_locations(self, rows=None):
+        """Boxes after one prediction step, one per row."""
+        return self._predict(self.rows() if rows is None else rows)[0]
+
+    def advance_prediction(self, steps, rows=None):
+        """Carry trackers forward along their velocities for steps frames."""
+        rows = self._all(rows)
+        for _ in range(steps):
+            boxes, self.velocities[rows], moving = self._predict(rows)
+            self.boxes[rows[moving]] = self.raw_boxes[rows[moving]] = boxes[moving]
+
+    def mark_missed(self, rows=None):
+        """Count a frame without a detection and move the trackers to their predicted boxes."""
+        rows = self._all(rows)
+        self.missed[rows] += 1
+        self.advance_prediction(1, rows)
+
+    def forgive_misses(self, count):
+        """Take back count missed frames from every tracker, e.g. when a skipped detection showed nothing moved."""
+        live = self.missed[:len(self._views)]
+        np.maximum(live - count, 0, out=live)
+
+    def expired(self, rows=None):
+        return self.missed[self.rows() if rows is None else rows] > TRACKING_FRAMES
+
+    def remove_expired(self):
+        """Drop every tracker missed for more than TRACKING_FRAMES frames; returns their ids."""
+        expired_ids = [self._views[row].id for row in np.flatnonzero(self.missed[:len(self._views)] > TRACKING_FRAMES)]
+        for face_id in expired_ids:
+            del self[face_id]
+        return expired_ids
+
+    def mean_confidences(self, rows=None):
+        """Mean recent confidence per row, 0.0 for trackers never identified."""
+        rows = self.rows() if rows is None else rows
+        filled = np.minimum(self.confidence_count[rows], CONFIDENCE_WINDOW)
+        in_window = np.arange(CONFIDENCE_WINDOW)[None, :] < filled[:, None]
+        totals = np.where(in_window, self.confidences[rows], 0.0).sum(axis=1)
+        return np.divide(totals, filled, out=np.zeros(len(rows)), where=filled > 0)
+
+class LatencyHistogram:
+    """Cumulative latency histogram in Prometheus bucket layout."""
+    def __init__(self, buckets=STAGE_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.total += seconds
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class ServiceMetrics:
+    """Process-wide pipeline metrics exported at /metrics."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {stage: LatencyHistogram() for stage in PIPELINE_STAGES}
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        self.gate_checks = 0
+        self.frames_skipped = 0
+
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage].observe(seconds)
+
+    def count_frame(self, dropped=False):
+        with self.lock:
+            if dropped:
+                self.frames_dropped += 1
+            else:
+                self.frames_processed += 1
+
+    def count_gate(self, skipped):
+        with self.lock:
+            self.gate_checks += 1
+            self.frames_skipped += skipped
+
+    def skip_ratio(self):
+        with self.lock:
+            return round(self.frames_skipped / self.gate_checks, 4) if self.gate_checks else 0.0
+
+    def render(self, gauges):
+        """Render the Prometheus text exposition; gauges maps metric name to (help, value)."""
+        lines = [
+            "# HELP facial_recognition_stage_seconds Time spent in each frame pipeline stage.",
+            "# TYPE facial_recognition_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, histogram in self.stages.items():
+                lines.extend(histogram.render("facial_recognition_stage_seconds", f'stage="{stage}"'))
+            counters = {
+                "facial_recognition_frames_processed_total": ("Frames run through the recognition pipeline.", self.frames_processed),
+                "facial_recognition_frames_dropped_total": ("Frames superseded by a newer frame before processing.", self.frames_dropped),
+                "facial_recognition_frames_skipped_total": ("Frames answered from tracker state because the scene had not changed.", self.frames_skipped),
+            }
+        for name, (help_text, value) in counters.items():
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"])
+        for name, (help_text, value) in gauges.items():
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"])
+        return "\n".join(lines) + "\n"
+
+metrics = ServiceMetrics()
+
+def load_face_recognition():
+    """Import face_recognition (and dlib's models) on first use and return the module."""
+    global face_recognition
+    if face_recognition is None:
+        with face_recognition_lock:
+            if face_recognition is None:
+                import face_recognition as module
+                face_recognition = module
+    return face_recognition
+
+class StartupState:
+    """Tracks warmup phases so /readyz can report progress and startup timings."""
+    PHASES = ("importing", "loading_gallery", "warming_up", "ready")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase = "starting"
+        self.started = False
+        self.error = None
+        self.progress = None
+        self.phase_seconds = {}
+        self.ready_after = None  # Seconds from process start to ready
+        self.phase_started = time.time()
+
+    def enter(self, phase):
+        with self.lock:
+            now = time.time()
+            if self.phase in self.PHASES:
+                self.phase_seconds[self.phase] = round(now - self.phase_started, 3)
+            self.phase = phase
+            self.phase_started = now
+            self.progress = None
+            if phase == "ready":
+                self.ready_after = round(now - PROCESS_STARTED, 3)
+
+    def set_progress(self, done, total):
+        with self.lock:
+            self.progress = {"done": done, "total": total}
+
+    def fail(self, error):
+        with self.lock:
+            self.phase = "failed"
+            self.error = str(error)
+
+    def skip(self):
+        """Mark startup done without warming up, for in-process callers that set their own gallery.
+
+        Frame endpoints then answer immediately and no background warmup
+        replaces the gallery with photos/.
+        """
+        with self.lock:
+            self.started = True
+            self.phase = "ready"
+
+    def not_ready_payload(self):
+        """Error payload for frame requests before the gallery is loaded, or None once it is."""
+        if self.gallery_loaded:
+            return None
+        snapshot = self.snapshot()
+        if snapshot["phase"] == "failed":
+            return {"status": "error", "message": f"Service failed to start: {snapshot['error']}", "startup": snapshot}
+        return {"status": "error", "message": "Service is warming up", "startup": snapshot}
+
+    @property
+    def ready(self):
+        return self.phase == "ready"
+
+    @property
+    def gallery_loaded(self):
+        return self.phase in ("warming_up", "ready")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "phase": self.phase,
+                "progress": self.progress,
+                "error": self.error,
+                "phase_seconds": dict(self.phase_seconds),
+                "seconds_to_ready": self.ready_after,
+                "uptime_seconds": round(time.time() - PROCESS_STARTED, 3),
+            }
+
+startup_state = StartupState()
+
+@contextmanager
+def timed_stage(stage):
+    """Record the duration of the enclosed block under a pipeline stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe_stage(stage, time.perf_counter() - started)
+
+class AttendanceEventLog:
+    """Append-only SQLite log of "student confirmed" events.
+
+    record() only appends to an in-memory buffer; a background thread writes
+    the buffer in one transaction every EVENT_FLUSH_INTERVAL seconds, or
+    sooner once EVENT_FLUSH_BATCH events are pending. Event ids increase
+    monotonically, so clients poll with the last id they saw as a cursor.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.connection = None
+        self.wake = threading.Event()
+        self.flusher = None
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS attendance_events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "created_at REAL NOT NULL, "
+                "session_id TEXT NOT NULL, "
+                "student_name TEXT NOT NULL, "
+                "tracker_id INTEGER, "
+                "confidence REAL, "
+                "event_type TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS attendance_events_session ON attendance_events (session_id, id)")
+            self.connection.commit()
+        return self.connection
+
+    def record(self, session_id, student_name, tracker_id, confidence, event_type="confirmed"):
+        with self.lock:
+            self.pending.append((time.time(), session_id, student_name, tracker_id, confidence, event_type))
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_loop, name="attendance-events", daemon=True)
+                self.flusher.start()
+            if len(self.pending) >= EVENT_FLUSH_BATCH:
+                self.wake.set()
+
+    def _flush_loop(self):
+        while True:
+            self.wake.wait(EVENT_FLUSH_INTERVAL)
+            self.wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"❌ Could not write attendance events: {e}")
+
+    def flush(self):
+        """Write all buffered events in one transaction."""
+        with self.write_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return 0
+            try:
+                connection = self._connect()
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO attendance_events (created_at, session_id, student_name, tracker_id, confidence, event_type) VALUES (?, ?, ?, ?, ?, ?)",
+                        batch,
+                    )
+            except sqlite3.Error:
+                with self.lock:
+                    self.pending[:0] = batch  # Keep the events for the next attempt
+                raise
+            return len(batch)
+
+    def fetch(self, since=0, limit=EVENT_FETCH_LIMIT, session_id=None):
+        """Return events with id > since, oldest first, after flushing anything buffered."""
+        self.flush()
+        query = "SELECT id, created_at, session_id, student_name, tracker_id, confidence, event_type FROM attendance_events WHERE id > ?"
+        params = [since]
+        if session_id is not None:
+            query += " AND session_id = ?"
+            params.append(session_id)
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        with self.write_lock:
+            rows = self._connect().execute(query, params).fetchall()
+        return [
+            {"id": row[0], "created_at": row[1], "session_id": row[2], "student_name": row[3], "tracker_id": row[4], "confidence": row[5], "event_type": row[6]}
+            for row in rows
+        ]
+
+attendance_events = AttendanceEventLog(ATTENDANCE_EVENT_DB)
+atexit.register(lambda: attendance_events.flush())
+
+class QualityController:
+    """Chooses detection scale, upsampling and landmark model for one session.
+
+    A named profile pins the settings. In "auto" mode the controller starts at
+    "balanced", shrinks the downscale factor while the smallest tracked face
+    stays comfortably detectable (every QUALITY_PROBE_INTERVAL detection
+    frames runs at the profile's own scale, so newcomers and faces further
+    back than the smallest one seen are still picked up), steps down a profile when detect+encode
+    latency stays over FRAME_LATENCY_BUDGET_MS (but never to one that would
+    shrink that face below HOG_MIN_FACE_PX), and steps back up when there is
+    headroom.
+    """
+    def __init__(self, profile=DEFAULT_QUALITY_PROFILE):
+        self.set_profile(profile)
+
+    def set_profile(self, profile):
+        if profile != "auto" and profile not in QUALITY_PROFILES:
+            raise ValueError(f"Unknown quality profile '{profile}'")
+        self.requested = profile
+        self.adaptive = profile == "auto"
+        self.profile = "balanced" if self.adaptive else profile
+        self.avg_latency_ms = None
+        self.smallest_face_px = None
+        self.over_budget_frames = 0
+        self.under_budget_frames = 0
+        self.frames_since_probe = 0
+
+    def settings(self):
+        profile = QUALITY_PROFILES[self.profile]
+        scale = profile["scale"]
+        probe = self.adaptive and self.frames_since_probe >= QUALITY_PROBE_INTERVAL
+        if self.adaptive and self.smallest_face_px and not probe:
+            detectable_px = HOG_MIN_FACE_PX / (2 ** profile["upsample"]) * FACE_SIZE_MARGIN
+            scale = min(scale, detectable_px / self.smallest_face_px)
+        # Quantize so small size fluctuations do not change the frame size every frame
+        scale = max(MIN_DETECTION_SCALE, round(scale * 20) / 20)
+        return {
+            "profile": self.profile,
+            "scale": scale,
+            "factor": 1.0 / scale,
+            "upsample": profile["upsample"],
+            "landmarks": profile["landmarks"],
+            "probe": probe,
+        }
+
+    def observe(self, latency_ms, face_heights, probe=False):
+        """Feed back one frame's detect+encode latency and full-frame face heights.
+
+        A probe frame ran at the profile's full scale: its smallest face
+        replaces the running estimate, and its (higher) latency is left out of
+        the average so probing alone never steps the profile down.
+        """
+        if probe:
+            self.frames_since_probe = 0
+            if face_heights:
+                self.smallest_face_px = float(min(face_heights))
+            return
+        self.frames_since_probe += 1
+        if self.avg_latency_ms is None:
+            self.avg_latency_ms = latency_ms
+        else:
+            self.avg_latency_ms += PROCESSING_TIME_SMOOTHING * (latency_ms - self.avg_latency_ms)
+        if face_heights:
+            smallest = float(min(face_heights))
+            if self.smallest_face_px is None:
+                self.smallest_face_px = smallest
+            else:
+                self.smallest_face_px += PROCESSING_TIME_SMOOTHING * (smallest - self.smallest_face_px)
+        if not self.adaptive:
+            return
+
+        position = QUALITY_PROFILE_ORDER.index(self.profile)
+        if self.avg_latency_ms > FRAME_LATENCY_BUDGET_MS:
+            self.over_budget_frames += 1
+            self.under_budget_frames = 0
+            if (self.over_budget_frames >= QUALITY_STEP_DOWN_FRAMES and position > 0
+                    and self._can_detect_faces(QUALITY_PROFILE_ORDER[position - 1])):
+                self._step_to(QUALITY_PROFILE_ORDER[position - 1])
+        elif self.avg_latency_ms < FRAME_LATENCY_BUDGET_MS / 2:
+            self.under_budget_frames += 1
+            self.over_budget_frames = 0
+            if self.under_budget_frames >= QUALITY_STEP_UP_FRAMES and position < len(QUALITY_PROFILE_ORDER) - 1:
+                self._step_to(QUALITY_PROFILE_ORDER[position + 1])
+        else:
+            self.over_budget_frames = 0
+            self.under_budget_frames = 0
+
+    def _can_detect_faces(self, profile):
+        """Whether the smallest tracked face stays above HOG_MIN_FACE_PX under a profile."""
+        if not self.smallest_face_px:
+            return False
+        settings = QUALITY_PROFILES[profile]
+        detectable_px = HOG_MIN_FACE_PX / (2 ** settings["upsample"]) * FACE_SIZE_MARGIN
+        return self.smallest_face_px * settings["scale"] >= detectable_px
+
+    def _step_to(self, profile):
+        logger.info(f"Quality profile {self.profile} -> {profile} (avg detect+encode {self.avg_latency_ms:.0f}ms, budget {FRAME_LATENCY_BUDGET_MS:.0f}ms)")
+        self.profile = profile
+        self.over_budget_frames = 0
+        self.under_budget_frames = 0
+
+    def stats(self):
+        return dict(
+            self.settings(),
+            requested=self.requested,
+            avg_latency_ms=round(self.avg_latency_ms, 1) if self.avg_latency_ms is not None else None,
+            smallest_face_px=round(self.smallest_face_px, 1) if self.smallest_face_px is not None else None,
+        )
+
+class TrackingSession:
+    """Tracker state for one classroom stream, isolated from other sessions."""
+    def __init__(self, session_id):
+        self.id = session_id
+        self.face_tracker = TrackerStore()
+        self.next_face_id = 0
+        self.frame_count = 0
+        self.lock = threading.Lock()  # Serializes frames within this session only
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        # Latest-frame-wins slot: a newer frame replaces one still waiting to be processed
+        self.frame_slot = threading.Condition()
+        self.pending_frame = None  # (sequence, frame)
+        self.frame_sequence = 0
+        self.processing = False
+        self.in_flight = 0
+        self.frames_received = 0
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        self.dropped_since_processed = 0
+        self.avg_processing_ms = 0.0
+        self.faces_detected = 0
+        self.faces_encoded = 0
+        self.previous_thumbnail = None  # Thumbnail of the last frame the detector ran on
+        self.frames_since_full_sweep = 0
+        self.gate_checks = 0
+        self.frames_skipped = 0
+        self.skipped_in_a_row = 0
+        self.frames_since_detection = 0  # Camera frames marked missed since the last detection frame
+        self.detector_pixels = 0
+        self.frame_pixels = 0
+        self.last_detection_stats = {"mode": "full", "pixels": 0, "frame_pixels": 0}
+        self.quality = QualityController()
+        self.record_events = True  # Emit attendance events; off for offline batch sessions
+        self.confirmed_names = set()  # Students already announced in this session
+        self.roster = None  # (course_id, frozenset of student keys) to match against first; None = full gallery
+        self.roster_matches = 0
+        self.roster_fallbacks = 0  # Faces no roster student matched, searched in the full gallery
+        self.roster_outsiders = 0  # Of those, faces identified as students outside the roster
+        self.last_encoding_stats = {"detected": 0, "encoded": 0, "reused": 0}
+
+    def record_encoding_stats(self, detected, encoded):
+        self.faces_detected += detected
+        self.faces_encoded += encoded
+        self.last_encoding_stats = {"detected": detected, "encoded": encoded, "reused": detected - encoded}
+
+    def record_detection_stats(self, mode, pixels, frame_pixels):
+        self.detector_pixels += pixels
+        self.frame_pixels += frame_pixels
+        self.last_detection_stats = {"mode": mode, "pixels": int(pixels), "frame_pixels": int(frame_pixels)}
+
+    def detection_stats(self):
+        return {
+            "frame": self.last_detection_stats,
+            # Share of full-frame pixels the detector actually scanned
+            "pixel_ratio": round(self.detector_pixels / self.frame_pixels, 4) if self.frame_pixels else 1.0,
+            "frames_skipped": self.frames_skipped,
+            "skip_rate": round(self.frames_skipped / self.gate_checks, 4) if self.gate_checks else 0.0,
+        }
+
+    def encoding_stats(self):
+        return {
+            "frame": self.last_encoding_stats,
+            "total_detected": self.faces_detected,
+            "total_encoded": self.faces_encoded,
+            "total_reused": self.faces_detected - self.faces_encoded,
+        }
+
+    def set_roster(self, course_id, students):
+        """Scope recognition to the given student keys; an empty or None roster restores the full gallery."""
+        if not students:
+            self.roster = None
+            return
+        self.roster = (course_id or f"session:{self.id}", frozenset(student_key(student) for student in students))
+
+    def roster_stats(self):
+        roster = self.roster
+        if roster is None:
+            return None
+        course_id, student_keys = roster
+        enrolled = {student_key(name) for name in roster_galleries.get(course_id, student_keys).names}
+        return {
+            "course_id": course_id,
+            "students": len(student_keys),
+            # Roster students with no reference photo can never be recognized
+            "missing_photos": sorted(student_keys - enrolled),
+            "roster_matches": self.roster_matches,
+            "fallback_searches": self.roster_fallbacks,
+            "outside_roster": self.roster_outsiders,
+        }
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def reset(self):
+        self.face_tracker.clear()
+        self.confirmed_names.clear()
+        self.previous_thumbnail = None  # Nothing is tracked, so the next frame must be detected
+        self.next_face_id = 0
+        self.frame_count = 0
+
+    def is_idle(self, now=None):
+        return (now or time.time()) - self.last_active > SESSION_IDLE_TIMEOUT
+
+    def scheduler_stats(self):
+        return {
+            "frames_received": self.frames_received,
+            "frames_processed": self.frames_processed,
+            "frames_dropped": self.frames_dropped,
+            "avg_processing_ms": round(self.avg_processing_ms, 1),
+            # Sending faster than this only produces dropped frames
+            "recommended_interval_ms": int(max(MIN_FRAME_INTERVAL_MS, self.avg_processing_ms)),
+        }
+
+    def summary(self):
+        return {
+            "session_id": self.id,
+            "active_trackers": len(self.face_tracker),
+            "frames": self.frame_count,
+            "idle_seconds": round(time.time() - self.last_active, 1),
+            "scheduler": self.scheduler_stats(),
+            "encoding": self.encoding_stats(),
+            "detection": self.detection_stats(),
+            "quality": self.quality.stats(),
+            "roster": self.roster_stats(),
+        }
+
+def evict_idle_sessions(now=None):
+    """Drop sessions that have not sent frames within SESSION_IDLE_TIMEOUT."""
+    now = now or time.time()
+    with tracking_sessions_lock:
+        for session_id, session in list(tracking_sessions.items()):
+            # Never evict a session that is mid-frame
+            if session.is_idle(now) and session.in_flight == 0 and not session.lock.locked():
+                logger.info(f"Evicting idle tracking session {session_id}")
+                del tracking_sessions[session_id]
+
+def get_tracking_session(session_id):
+    """Return the session for session_id, creating it on first use."""
+    evict_idle_sessions()
+    with tracking_sessions_lock:
+        session = tracking_sessions.get(session_id)
+        if session is None:
+            session = TrackingSession(session_id)
+            tracking_sessions[session_id] = session
+        session.touch()
+        return session
+
+def request_session_id(data=None):
+    """Read the session id from the JSON body, X-Session-Id header or query string."""
+    session_id = (data or {}).get('session_id') or request.headers.get('X-Session-Id') or request.args.get('session_id')
+    return str(session_id) if session_id else DEFAULT_SESSION_ID
+
+def apply_requested_quality(session, data=None):
+    """Switch the session's quality profile if the request names one.
+
+    Read from the JSON body "quality", X-Quality-Profile header or quality
+    query parameter. Raises ValueError for unknown profiles.
+    """
+    profile = (data or {}).get('quality') or request.headers.get('X-Quality-Profile') or request.args.get('quality')
+    if profile and profile != session.quality.requested:
+        with session.lock:
+            session.quality.set_profile(profile)
+
+camera_session = TrackingSession(CAMERA_SESSION_ID)  # Trackers for the server-side camera feed
+
+def _photo_fingerprint(path):
+    """Return (size, mtime_ns) used to cheaply detect changed photos."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def _photo_content_hash(path):
+    """Return the SHA-1 hex digest of a photo's bytes."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_gallery_cache(cache_path=GALLERY_CACHE_FILE):
+    """Load the persisted gallery cache, keyed by photo filename."""
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            if int(data['version']) != GALLERY_CACHE_VERSION:
+                logger.info("Gallery cache version mismatch, rebuilding")
+                return {}
+            encodings = data['encodings']
+            entries = {}
+            for i, filename in enumerate(data['filenames'].tolist()):
+                entries[filename] = {
+                    "hash": str(data['hashes'][i]),
+                    "size": int(data['sizes'][i]),
+                    "mtime_ns": int(data['mtimes'][i]),
+                    "has_face": bool(data['has_face'][i]),
+                    "encoding": encodings[i] if data['has_face'][i] else None,
+                }
+            return entries
+    except Exception as e:
+        logger.warning(f"⚠️ Could not read gallery cache {cache_path}: {e}")
+        return {}
+
+def _save_gallery_cache(entries, cache_path=GALLERY_CACHE_FILE):
+    """Atomically persist gallery entries as a contiguous float32 matrix plus metadata."""
+    filenames = sorted(entries)
+    encodings = np.zeros((len(filenames), 128), dtype=np.float32)
+    has_face = np.zeros(len(filenames), dtype=bool)
+    for i, filename in enumerate(filenames):
+        encoding = entries[filename]["encoding"]
+        if encoding is not None:
+            encodings[i] = encoding
+            has_face[i] = True
+    tmp_path = cache_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                version=np.int32(GALLERY_CACHE_VERSION),
+                filenames=np.array(filenames, dtype=str),
+                hashes=np.array([entries[n]["hash"] for n in filenames], dtype=str),
+                sizes=np.array([entries[n]["size"] for n in filenames], dtype=np.int64),
+                mtimes=np.array([entries[n]["mtime_ns"] for n in filenames], dtype=np.int64),
+                has_face=has_face,
+                encodings=encodings,
+            )
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"⚠️ Could not write gallery cache {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _scan_photos(photos_dir=None):
+    """Return [(readable_name, filename, path)] for every image in photos_dir."""
+    photos_dir = photos_dir or PHOTOS_DIR
     reference_people = []
     if os.path.exists(photos_dir):
-        for filename in os.listdir(photos_dir):
+        for filename in sorted(os.listdir(photos_dir)):
             # Check if file is an image
             if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
                 # Convert filename to readable name
@@ -139,64 +1039,621 @@ def load_reference_data():
                 name_without_ext = os.path.splitext(filename)[0]
                 readable_name = name_without_ext.replace('_', ' ').title()
                 file_path = os.path.join(photos_dir, filename)
-                reference_people.append((readable_name, file_path))
-    
-    print(f"   Found {len(reference_people)} image file(s) in {photos_dir}")
+                reference_people.append((readable_name, filename, file_path))
+    return reference_people
+
+def reload_gallery(photos_dir=None, progress=None):
+    """Bring the gallery in line with photos_dir, encoding only added or changed photos.
+
+    Entries from the previous load (or GALLERY_CACHE_FILE on first load) are
+    reused when a photo's size/mtime or content hash is unchanged; photos
+    that disappeared are dropped. The new gallery is swapped in with
+    set_gallery(), so frames being matched keep using the previous index
+    until the swap and live trackers are untouched. progress(done, total) is
+    called after each photo. Returns change counts.
+    """
+    global gallery_entries
+    photos_dir = photos_dir or PHOTOS_DIR
     
-    for name, path in reference_people:
-        print(f"   - Loading {name} from {path}...")
-        print(f"     Full path: {os.path.abspath(path)}")
-        print(f"     File exists: {os.path.exists(path)}")
+    with gallery_reload_lock:
+        reference_people = _scan_photos(photos_dir)
+        previous_entries = gallery_entries if gallery_entries is not None else _load_gallery_cache()
+        entries = {}
+        gallery_encodings = []
+        gallery_names = []
+        stats = {"added": 0, "changed": 0, "removed": 0, "reused": 0, "encoded": 0, "failed": 0}
         
-        try:
-            if os.path.exists(path):
-                image = face_recognition.load_image_file(path)
-                face_encodings_list = face_recognition.face_encodings(image)
+        for done, (name, filename, path) in enumerate(reference_people, 1):
+            try:
+                size, mtime_ns = _photo_fingerprint(path)
+                cached = previous_entries.get(filename)
                 
-                if face_encodings_list:
-                    encoding = face_encodings_list[0]
-                    known_face_encodings.append(encoding)
-                    known_face_names.append(name)
-                    print(f"     ✓ Face encoding extracted for {name}.")
+                # Fast path: size and mtime unchanged, trust the cached encoding
+                if cached and cached["size"] == size and cached["mtime_ns"] == mtime_ns:
+                    entry = cached
+                    stats["reused"] += 1
                 else:
-                    print(f"     ⚠️ Warning: No faces found in {path}. The image might not contain a clear face.")
-            else:
-                print(f"     ❌ Error: Reference image not found at '{path}'.")
-                # List what files are actually in the photos directory
-                if os.path.exists(photos_dir):
-                    files = os.listdir(photos_dir)
-                    print(f"     Available files in {photos_dir}: {files}")
-        except Exception as e:
-            print(f"     ❌ Error processing {path}: {e}")
+                    content_hash = _photo_content_hash(path)
+                    if cached and cached["hash"] == content_hash:
+                        # File was touched but its content is identical
+                        entry = dict(cached, size=size, mtime_ns=mtime_ns)
+                        stats["reused"] += 1
+                    else:
+                        logger.debug(f"Encoding {name} from {path}...")
+                        fr = load_face_recognition()
+                        image = fr.load_image_file(path)
+                        face_encodings_list = fr.face_encodings(image)
+                        entry = {
+                            "hash": content_hash,
+                            "size": size,
+                            "mtime_ns": mtime_ns,
+                            "has_face": bool(face_encodings_list),
+                            "encoding": face_encodings_list[0] if face_encodings_list else None,
+                        }
+                        stats["encoded"] += 1
+                        stats["changed" if cached else "added"] += 1
+                entries[filename] = entry
+                
+                if entry["has_face"]:
+                    gallery_encodings.append(entry["encoding"])
+                    gallery_names.append(name)
+                else:
+                    logger.warning(f"⚠️ No faces found in {path}. The image might not contain a clear face.")
+            except Exception as e:
+                stats["failed"] += 1
+                logger.error(f"❌ Error processing {path}: {e}")
+            if progress:
+                progress(done, len(reference_people))
+        
+        stats["removed"] = len(set(previous_entries) - set(entries))
+        
+        # Only rewrite the cache when the roster actually changed
+        if stats["encoded"] or set(entries) != set(previous_entries) or any(
+            entries[n] is not previous_entries.get(n) for n in entries
+        ):
+            _save_gallery_cache(entries)
+        
+        set_gallery(gallery_encodings, gallery_names)
+        gallery_entries = entries
+        stats["gallery_size"] = len(gallery_names)
+        return stats
+
+def sync_gallery(progress=None):
+    """Reload the gallery, through the shared gallery file when SHARED_GALLERY_FILE is set.
+
+    In shared mode the first worker to take the lock encodes and publishes;
+    the others find a file built from the same photos and index settings and
+    just map it.
+    """
+    global gallery_entries
+    if not SHARED_GALLERY_FILE:
+        return reload_gallery(progress=progress)
+    
+    with shared_gallery_lock():
+        source = (_photos_signature(), _gallery_index_config())
+        signature = hashlib.sha1(repr(source).encode('utf-8')).hexdigest()
+        header, _ = read_shared_gallery_header()
+        if header is not None and header["source_signature"] == signature:
+            attach_shared_gallery()
+            return {"added": 0, "changed": 0, "removed": 0, "reused": header["count"], "encoded": 0, "failed": 0,
+                    "gallery_size": header["count"], "shared": "attached"}
+        stats = reload_gallery(progress=progress)
+        publish_shared_gallery(gallery_index, signature)
+        # Serve from the mapping too and drop the private copy; the next reload reads GALLERY_CACHE_FILE
+        attach_shared_gallery()
+        gallery_entries = None
+        stats["shared"] = "published"
+        return stats
+
+def load_reference_data(progress=None):
+    """Load reference images and extract face encodings.
+
+    Encodings are persisted in GALLERY_CACHE_FILE so only new or changed
+    photos are re-encoded on restart.
+    """
+    logger.info("📸 Loading reference images...")
+    logger.debug(f"Photos directory: {PHOTOS_DIR}")
+    logger.debug(f"Directory exists: {os.path.exists(PHOTOS_DIR)}")
     
-    print(f"✅ Loaded {len(known_face_encodings)} face encodings: {', '.join(known_face_names)}")
+    stats = sync_gallery(progress=progress)
+    
+    logger.info(f"Gallery cache: {stats['reused']} reused, {stats['encoded']} encoded")
+    logger.info(f"✅ Loaded {len(known_face_encodings)} face encodings: {', '.join(known_face_names)}")
     
     if len(known_face_encodings) == 0:
-        print("⚠️ Warning: No face encodings loaded. Face recognition will only detect unknown faces.")
+        logger.warning("⚠️ No face encodings loaded. Face recognition will only detect unknown faces.")
     
     return True  # Return True even if no encodings to allow detection of unknown faces
 
+def _photos_signature(photos_dir=None):
+    """Cheap (filename, size, mtime) snapshot used by the watcher to notice changes."""
+    photos_dir = photos_dir or PHOTOS_DIR
+    signature = []
+    for _, filename, path in _scan_photos(photos_dir):
+        try:
+            signature.append((filename,) + _photo_fingerprint(path))
+        except OSError:
+            continue
+    return tuple(signature)
+
+def start_gallery_watcher(interval=None):
+    """Poll photos/ every GALLERY_WATCH_INTERVAL seconds and hot-reload the gallery on changes."""
+    interval = interval or GALLERY_WATCH_INTERVAL
+    if interval <= 0:
+        return None
+    
+    def watch():
+        signature = _photos_signature()
+        while True:
+            time.sleep(interval)
+            try:
+                current = _photos_signature()
+                if current == signature:
+                    continue
+                stats = sync_gallery()
+                signature = current
+                logger.info(f"🔄 Gallery reloaded: {stats['added']} added, {stats['changed']} changed, {stats['removed']} removed ({stats['gallery_size']} faces)")
+            except Exception as e:
+                logger.error(f"❌ Gallery reload failed: {e}")
+    
+    watcher = threading.Thread(target=watch, name="gallery-watcher", daemon=True)
+    watcher.start()
+    logger.info(f"Watching {PHOTOS_DIR} for gallery changes every {interval}s")
+    return watcher
+
+def _pairwise_sq_distances(queries, matrix, sq_norms):
+    """Squared Euclidean distances between every query row and every matrix row."""
+    q_sq_norms = np.einsum('ij,ij->i', queries, queries)
+    sq_distances = q_sq_norms[:, None] + sq_norms[None, :] - 2.0 * (queries @ matrix.T)
+    np.maximum(sq_distances, 0.0, out=sq_distances)
+    return sq_distances
+
+class BruteForceGalleryIndex:
+    """Exact nearest-neighbour search over the full gallery matrix."""
+    mode = "brute"
+
+    def __init__(self, encodings, names):
+        self.encodings = encodings
+        self.sq_norms = np.einsum('ij,ij->i', encodings, encodings)
+        self.names = names
+        self.recall = 1.0
+
+    def __len__(self):
+        return len(self.names)
+
+    def shared_layout(self):
+        """Return (names, arrays, params) to publish this index in a shared gallery file."""
+        return list(self.names), {"encodings": self.encodings, "sq_norms": self.sq_norms}, {"recall": self.recall}
+
+    @classmethod
+    def from_shared(cls, names, arrays, params):
+        """Rebuild the index around arrays mapped from a shared gallery file, without copying them."""
+        index = cls.__new__(cls)
+        index.encodings = arrays["encodings"]
+        index.sq_norms = arrays["sq_norms"]
+        index.names = names
+        index.recall = params["recall"]
+        return index
+
+    def roster_subset(self, student_keys):
+        """Exact index over only the entries whose student_key() is in student_keys."""
+        rows = [i for i, name in enumerate(self.names) if student_key(name) in student_keys]
+        return BruteForceGalleryIndex(np.ascontiguousarray(self.encodings[rows]), [self.names[i] for i in rows])
+
+    def search(self, queries):
+        """Return (best_indices, best_distances) for each query row."""
+        sq_distances = _pairwise_sq_distances(queries, self.encodings, self.sq_norms)
+        best_indices = np.argmin(sq_distances, axis=1)
+        best_distances = np.sqrt(sq_distances[np.arange(len(queries)), best_indices])
+        return best_indices, best_distances
+
+    def stats(self):
+        return {"mode": self.mode, "size": len(self), "recall": self.recall}
+
+class IVFGalleryIndex:
+    """Approximate search: k-means partitions the gallery into inverted lists
+    and each query only scans the n_probe lists with the closest centroids."""
+    mode = "ivf"
+
+    def __init__(self, encodings, names, n_lists=None, n_probe=None, kmeans_iterations=10, seed=0):
+        self.names = names
+        n = len(encodings)
+        self.n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        self.n_probe = max(1, min(self.n_lists, n_probe or GALLERY_INDEX_NPROBE))
+        self.recall = None
+        
+        rng = np.random.default_rng(seed)
+        centroids = encodings[rng.choice(n, self.n_lists, replace=False)].copy()
+        for _ in range(kmeans_iterations):
+            assignments = np.argmin(_pairwise_sq_distances(encodings, centroids, np.einsum('ij,ij->i', centroids, centroids)), axis=1)
+            for list_id in range(self.n_lists):
+                members = encodings[assignments == list_id]
+                if len(members):
+                    centroids[list_id] = members.mean(axis=0)
+        self.centroids = np.ascontiguousarray(centroids)
+        self.centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        
+        # Store each inverted list as a contiguous slice of a reordered matrix
+        self.order = np.argsort(assignments, kind='stable')
+        self.encodings = np.ascontiguousarray(encodings[self.order])
+        self.sq_norms = np.einsum('ij,ij->i', self.encodings, self.encodings)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=self.n_lists))))
+
+    def __len__(self):
+        return len(self.names)
+
+    def shared_layout(self):
+        """Return (names, arrays, params) to publish this index in a shared gallery file.
+
+        Rows are already grouped by inverted list, so names are published in
+        that order too and the position-to-row mapping becomes the identity.
+        """
+        names = [self.names[i] for i in self.order]
+        arrays = {
+            "encodings": self.encodings,
+            "sq_norms": self.sq_norms,
+            "centroids": self.centroids,
+            "centroid_sq_norms": self.centroid_sq_norms,
+            "offsets": self.offsets.astype(np.int64),
+            "order": np.arange(len(names), dtype=np.int64),
+        }
+        return names, arrays, {"n_lists": self.n_lists, "n_probe": self.n_probe, "recall": self.recall}
+
+    @classmethod
+    def from_shared(cls, names, arrays, params):
+        """Rebuild the index around arrays mapped from a shared gallery file, without copying them."""
+        index = cls.__new__(cls)
+        index.names = names
+        index.n_lists = params["n_lists"]
+        index.n_probe = params["n_probe"]
+        index.recall = params["recall"]
+        for key in ("encodings", "sq_norms", "centroids", "centroid_sq_norms", "offsets", "order"):
+            setattr(index, key, arrays[key])
+        return index
+
+    def roster_subset(self, student_keys):
+        """Exact index over only the entries whose student_key() is in student_keys.
+
+        A roster is small enough that brute force beats probing inverted lists.
+        """
+        positions = [p for p, i in enumerate(self.order) if student_key(self.names[i]) in student_keys]
+        return BruteForceGalleryIndex(np.ascontiguousarray(self.encodings[positions]), [self.names[self.order[p]] for p in positions])
+
+    def search(self, queries):
+        """Return (best_indices, best_distances) for each query row; -1/inf when no candidates."""
+        coarse = _pairwise_sq_distances(queries, self.centroids, self.centroid_sq_norms)
+        if self.n_probe < self.n_lists:
+            probes = np.argpartition(coarse, self.n_probe - 1, axis=1)[:, :self.n_probe]
+        else:
+            probes = np.broadcast_to(np.arange(self.n_lists), (len(queries), self.n_lists))
+        
+        best_positions = np.full(len(queries), -1, dtype=np.int64)
+        best_sq_distances = np.full(len(queries), np.inf, dtype=np.float32)
+        # Visit each probed list once and score every query that probes it against the contiguous slice
+        for list_id in np.unique(probes):
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if start == end:
+                continue
+            query_ids = np.flatnonzero((probes == list_id).any(axis=1))
+            sq_distances = _pairwise_sq_distances(queries[query_ids], self.encodings[start:end], self.sq_norms[start:end])
+            local_best = np.argmin(sq_distances, axis=1)
+            local_sq = sq_distances[np.arange(len(query_ids)), local_best]
+            improved = local_sq < best_sq_distances[query_ids]
+            best_sq_distances[query_ids[improved]] = local_sq[improved]
+            best_positions[query_ids[improved]] = start + local_best[improved]
+        
+        found = best_positions >= 0
+        best_indices = np.where(found, self.order[np.maximum(best_positions, 0)], -1)
+        best_distances = np.sqrt(best_sq_distances)
+        return best_indices, best_distances
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "size": len(self),
+            "n_lists": self.n_lists,
+            "n_probe": self.n_probe,
+            "scan_fraction": round(self.n_probe / self.n_lists, 4),
+            "recall": self.recall,
+        }
+
+def measure_index_recall(index, encodings, sample_size=GALLERY_RECALL_SAMPLE_SIZE, noise=0.03, seed=0):
+    """Top-1 recall of an index against exact brute force on perturbed gallery rows."""
+    if len(encodings) == 0:
+        return 1.0
+    rng = np.random.default_rng(seed)
+    sample = encodings[rng.choice(len(encodings), min(sample_size, len(encodings)), replace=False)]
+    queries = (sample + rng.normal(0, noise, sample.shape)).astype(np.float32)
+    exact_indices, _ = BruteForceGalleryIndex(encodings, index.names).search(queries)
+    approx_indices, _ = index.search(queries)
+    return float(np.mean(exact_indices == approx_indices))
+
+def build_gallery_index(encodings, names, mode=None):
+    """Build the configured gallery index ("brute", "ivf" or "auto" by gallery size)."""
+    mode = mode or GALLERY_INDEX_MODE
+    if mode == "auto":
+        mode = "ivf" if len(encodings) >= GALLERY_INDEX_AUTO_THRESHOLD else "brute"
+    if mode == "ivf" and len(encodings) > 0:
+        index = IVFGalleryIndex(encodings, names)
+        index.recall = measure_index_recall(index, encodings)
+        logger.info(f"Gallery index: IVF with {index.n_lists} lists, probing {index.n_probe} (recall vs brute force: {index.recall:.3f})")
+        return index
+    return BruteForceGalleryIndex(encodings, names)
+
+def set_gallery(encodings, names):
+    """Replace the reference gallery with a preallocated, contiguous float32 matrix."""
+    global known_face_encodings, known_face_names, gallery_index
+    
+    matrix = np.empty((len(encodings), 128), dtype=np.float32)
+    for i, encoding in enumerate(encodings):
+        matrix[i] = encoding
+    names = list(names)
+    # Build the index first so readers always see a consistent snapshot
+    gallery_index = build_gallery_index(matrix, names)
+    known_face_encodings = matrix
+    known_face_names = names
+
+gallery_index = BruteForceGalleryIndex(known_face_encodings, known_face_names)
+GALLERY_INDEX_TYPES = {"brute": BruteForceGalleryIndex, "ivf": IVFGalleryIndex}
+shared_gallery_identity = None  # (st_ino, st_mtime_ns) of the shared gallery file currently mapped
+
+def _align(offset):
+    return (offset + SHARED_GALLERY_ALIGNMENT - 1) // SHARED_GALLERY_ALIGNMENT * SHARED_GALLERY_ALIGNMENT
+
+def _gallery_index_config():
+    """Index settings a shared gallery file must have been built with to be attached."""
+    return [GALLERY_INDEX_MODE, GALLERY_INDEX_NPROBE]
+
+def publish_shared_gallery(index, source_signature, path=None):
+    """Write the index to the shared gallery file and atomically replace the previous one.
+
+    Layout: magic, 8-byte header length, JSON header (names, index
+    parameters, array offsets), then each array aligned to 64 bytes.
+    Workers that still map the old file keep reading it until they remap.
+    """
+    path = path or SHARED_GALLERY_FILE
+    names, arrays, params = index.shared_layout()
+    specs = {}
+    offset = 0
+    for key, array in arrays.items():
+        offset = _align(offset)
+        specs[key] = {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.str}
+        offset += array.nbytes
+    header = json.dumps({
+        "mode": index.mode,
+        "count": len(names),
+        "names": names,
+        "params": params,
+        "arrays": specs,
+        "source_signature": source_signature,
+        "index_config": _gallery_index_config(),
+    }).encode('utf-8')
+    data_start = _align(len(SHARED_GALLERY_MAGIC) + 8 + len(header))
+    
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(SHARED_GALLERY_MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for key, array in arrays.items():
+                f.seek(data_start + specs[key]["offset"])
+                f.write(np.ascontiguousarray(array).tobytes())
+            # Seeking alone does not extend the file over trailing empty arrays
+            f.truncate(data_start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_shared_gallery_header(path=None):
+    """Return (header, data_start) of the shared gallery file, or (None, None) if missing or unreadable."""
+    path = path or SHARED_GALLERY_FILE
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(SHARED_GALLERY_MAGIC)) != SHARED_GALLERY_MAGIC:
+                return None, None
+            header_length = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        return header, _align(len(SHARED_GALLERY_MAGIC) + 8 + header_length)
+    except (OSError, ValueError):
+        return None, None
+
+def attach_shared_gallery(path=None):
+    """Map the shared gallery file read-only and install it as this process's gallery.
+
+    Returns the header, or None if there is no usable file.
+    """
+    global known_face_encodings, known_face_names, gallery_index, shared_gallery_identity
+    path = path or SHARED_GALLERY_FILE
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    header, data_start = read_shared_gallery_header(path)
+    if header is None:
+        return None
+    if header.get("index_config") != _gallery_index_config():
+        logger.warning(f"⚠️ Shared gallery {path} was built with index settings {header.get('index_config')}, not {_gallery_index_config()}; not attaching it")
+        return None
+    
+    mapped = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {
+        key: np.ndarray(tuple(spec["shape"]), dtype=np.dtype(spec["dtype"]), buffer=mapped, offset=data_start + spec["offset"])
+        for key, spec in header["arrays"].items()
+    }
+    index = GALLERY_INDEX_TYPES[header["mode"]].from_shared(header["names"], arrays, header["params"])
+    gallery_index = index
+    known_face_encodings = index.encodings
+    known_face_names = index.names
+    shared_gallery_identity = (stat.st_ino, stat.st_mtime_ns)
+    return header
+
+@contextmanager
+def shared_gallery_lock(path=None):
+    """Serialize gallery rebuilds across worker processes with an advisory lock file."""
+    path = path or SHARED_GALLERY_FILE
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def start_shared_gallery_follower(interval=SHARED_GALLERY_POLL_INTERVAL):
+    """Remap the shared gallery whenever another worker publishes a new one."""
+    if not SHARED_GALLERY_FILE:
+        return None
+    
+    def follow():
+        seen = None  # Last file tried, so one built with other index settings is not retried every poll
+        while True:
+            time.sleep(interval)
+            try:
+                stat = os.stat(SHARED_GALLERY_FILE)
+            except OSError:
+                continue
+            identity = (stat.st_ino, stat.st_mtime_ns)
+            if identity != shared_gallery_identity and identity != seen:
+                seen = identity
+                header = attach_shared_gallery()
+                if header is not None:
+                    logger.info(f"🔄 Mapped shared gallery with {header['count']} face(s)")
+    
+    follower = threading.Thread(target=follow, name="shared-gallery", daemon=True)
+    follower.start()
+    return follower
+
+def match_encodings_to_gallery(face_encodings, tolerance=TRACKING_THRESHOLD, index=None):
+    """Score all detections against the gallery index in one batched pass.
+
+    index defaults to the full gallery. Returns a list of (name, confidence)
+    pairs aligned with face_encodings; unmatched faces get ("Unknown", None).
+    """
+    results = [("Unknown", None)] * len(face_encodings)
+    index = index if index is not None else gallery_index
+    if len(face_encodings) == 0 or len(index) == 0:
+        return results
+    
+    queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, 128)
+    best_indices, best_distances = index.search(queries)
+    matched = (best_indices >= 0) & (best_distances <= tolerance)
+    
+    for i in np.flatnonzero(matched):
+        results[i] = (index.names[best_indices[i]], float(1 - best_distances[i]))
+    return results
+
+def student_key(name):
+    """Normalize a gallery name or roster entry to its photo filename stem, e.g. "Christian Esguerra" -> "christian_esguerra"."""
+    return name.strip().lower().replace(' ', '_')
+
+class RosterGalleryCache:
+    """LRU cache of compact per-course sub-galleries cut from the current gallery index.
+
+    Each entry holds a weak reference to the index it was cut from, so a hot
+    reload or newly attached shared gallery rebuilds it on next use without
+    keeping the old gallery alive.
+    """
+    def __init__(self, capacity=ROSTER_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # (course_id, student_keys) -> (weakref to source index, roster index)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+        self.evictions = 0
+
+    def get(self, course_id, student_keys):
+        source = gallery_index
+        key = (course_id, student_keys)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0]() is source:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        roster_index = source.roster_subset(student_keys)
+        with self.lock:
+            self.builds += 1
+            # Entries cut from a replaced gallery can never hit again
+            for stale in [k for k, (source_ref, _) in self.entries.items() if source_ref() is None]:
+                del self.entries[stale]
+            self.entries[key] = (weakref.ref(source), roster_index)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return roster_index
+
+    def stats(self):
+        with self.lock:
+            return {"cached": len(self.entries), "capacity": self.capacity, "hits": self.hits, "builds": self.builds, "evictions": self.evictions}
+
+roster_galleries = RosterGalleryCache()
+
+def match_encodings_for_session(session, face_encodings):
+    """Identify encodings for a session, scoped to its roster when it declared one.
+
+    Faces are scored against the course's sub-gallery first; only those no
+    roster student matches are searched in the full gallery.
+    """
+    roster = session.roster
+    if roster is None:
+        return match_encodings_to_gallery(face_encodings)
+    results = match_encodings_to_gallery(face_encodings, index=roster_galleries.get(*roster))
+    unknown = [i for i, (name, _) in enumerate(results) if name == "Unknown"]
+    session.roster_matches += len(results) - len(unknown)
+    if unknown:
+        session.roster_fallbacks += len(unknown)
+        for i, identity in zip(unknown, match_encodings_to_gallery([face_encodings[i] for i in unknown])):
+            results[i] = identity
+            session.roster_outsiders += identity[0] != "Unknown"
+    return results
+
 def calculate_distance(loc1, loc2):
     """Calculate Euclidean distance between two face locations."""
     center1 = ((loc1[1] + loc1[3]) // 2, (loc1[0] + loc1[2]) // 2)
     center2 = ((loc2[1] + loc2[3]) // 2, (loc2[0] + loc2[2]) // 2)
     return np.sqrt((center1[0] - center2[0])**2 + (center1[1] - center2[1])**2)
 
+def location_centers(locations):
+    """(x, y) centers of an (n, 4) array of (top, right, bottom, left) boxes, as calculate_distance computes them."""
+    locations = np.asarray(locations, dtype=np.int64).reshape(-1, 4)
+    return np.stack(((locations[:, 1] + locations[:, 3]) // 2, (locations[:, 0] + locations[:, 2]) // 2), axis=1)
+
+def pairwise_center_distances(locations_a, locations_b):
+    """Matrix of calculate_distance() between every box in locations_a and every box in locations_b."""
+    diff = location_centers(locations_a)[:, None, :] - location_centers(locations_b)[None, :, :]
+    return np.sqrt((diff.astype(np.float64) ** 2).sum(axis=2))
+
+def pairwise_iou(locations_a, locations_b):
+    """Intersection-over-union between every pair of (top, right, bottom, left) boxes."""
+    a = np.asarray(locations_a, dtype=np.float64).reshape(-1, 4)[:, None, :]
+    b = np.asarray(locations_b, dtype=np.float64).reshape(-1, 4)[None, :, :]
+    inter_h = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    inter_w = np.clip(np.minimum(a[..., 1], b[..., 1]) - np.maximum(a[..., 3], b[..., 3]), 0, None)
+    intersection = inter_h * inter_w
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 1] - a[..., 3])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 1] - b[..., 3])
+    union = area_a + area_b - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
 def deduplicate_face_locations(face_locations, threshold=DETECTION_DEDUP_THRESHOLD):
     """Remove duplicate face detections within threshold distance."""
-    deduplicated = []
-    for loc in face_locations:
-        is_duplicate = False
-        for existing in deduplicated:
-            c1 = ((loc[1] + loc[3]) // 2, (loc[0] + loc[2]) // 2)
-            c2 = ((existing[1] + existing[3]) // 2, (existing[0] + existing[2]) // 2)
-            dist = np.sqrt((c1[0] - c2[0])**2 + (c1[1] - c2[1])**2)
-            if dist < threshold:
-                is_duplicate = True
-                break
-        if not is_duplicate:
-            deduplicated.append(loc)
-    return deduplicated
+    if len(face_locations) < 2:
+        return list(face_locations)
+    close = pairwise_center_distances(face_locations, face_locations) < threshold
+    # Keep a detection unless it is close to one already kept (earlier detections win)
+    kept = np.zeros(len(face_locations), dtype=bool)
+    for i in range(len(face_locations)):
+        if not (close[i] & kept).any():
+            kept[i] = True
+    return [loc for loc, keep in zip(face_locations, kept) if keep]
 
 def smooth_face_locations(face_locations):
     """Smooth raw face detections to reduce jitter before tracking."""
@@ -209,245 +1666,910 @@ def smooth_face_locations(face_locations):
 
     return smoothed
 
-def merge_duplicate_trackers():
-    """Merge duplicate trackers with the same name that are close to each other."""
-    global face_tracker
+def _detect_faces(rgb_small_frame, deduplicate=True, regions=None, upsample=1):
+    """HOG-detect faces in a downscaled RGB frame, optionally only inside regions."""
+    fr = load_face_recognition()
+    if regions is None:
+        face_locations = fr.face_locations(rgb_small_frame, number_of_times_to_upsample=upsample, model="hog")
+    else:
+        face_locations = []
+        for top, right, bottom, left in regions:
+            crop = np.ascontiguousarray(rgb_small_frame[top:bottom, left:right])
+            for (t, r, b, l) in fr.face_locations(crop, number_of_times_to_upsample=upsample, model="hog"):
+                face_locations.append((t + top, r + left, b + top, l + left))
+    if deduplicate:
+        face_locations = smooth_face_locations(face_locations)
+        face_locations = deduplicate_face_locations(face_locations)
+    return face_locations
+
+def _encode_faces(rgb_small_frame, face_locations, landmarks="small"):
+    """Compute 128-d encodings for the given locations as an (n, 128) array."""
+    if not face_locations:
+        return np.empty((0, 128), dtype=np.float64)
+    face_encodings = load_face_recognition().face_encodings(rgb_small_frame, face_locations, model=landmarks)
+    return np.asarray(face_encodings, dtype=np.float64).reshape(-1, 128)
+
+FRAME_STAGES = {"detect": _detect_faces, "encode": _encode_faces}
+
+def _pool_run_stage(stage, shm_name, shape, dtype, *args):
+    """Worker entry point: view the parent's frame in shared memory and run one stage on it."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        rgb_small_frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = FRAME_STAGES[stage](rgb_small_frame, *args)
+        del rgb_small_frame  # Release the view before closing the mapping
+        return result
+    finally:
+        shm.close()
+
+detection_pool = None
+detection_pool_lock = threading.Lock()
+
+def get_detection_pool():
+    """Lazily start the detect/encode worker pool (None when DETECTION_WORKERS is 0)."""
+    global detection_pool
+    if DETECTION_WORKERS <= 0:
+        return None
+    with detection_pool_lock:
+        if detection_pool is None:
+            # Spawn rather than fork: the parent runs Flask request threads
+            detection_pool = ProcessPoolExecutor(max_workers=DETECTION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            logger.info(f"Started detection pool with {DETECTION_WORKERS} worker process(es)")
+        return detection_pool
+
+def shutdown_detection_pool():
+    global detection_pool
+    with detection_pool_lock:
+        if detection_pool is not None:
+            detection_pool.shutdown(wait=False, cancel_futures=True)
+            detection_pool = None
+
+class SharedFrame:
+    """A downscaled RGB frame handed to the detect/encode stages.
+
+    When the worker pool is enabled the frame is written once into a
+    shared-memory block that workers map directly, instead of being pickled
+    through the pool's pipe for every stage. Tracker matching stays in the
+    calling process.
+    """
+    def __init__(self, rgb_small_frame):
+        self.array = rgb_small_frame
+        self.pool = None
+        self.shm = None
+
+    def __enter__(self):
+        self.pool = get_detection_pool()
+        if self.pool is not None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.array.nbytes))
+            np.ndarray(self.array.shape, dtype=self.array.dtype, buffer=self.shm.buf)[...] = self.array
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def _run(self, stage, *args):
+        if self.shm is not None:
+            try:
+                future = self.pool.submit(_pool_run_stage, stage, self.shm.name, self.array.shape, self.array.dtype.str, *args)
+                return future.result()
+            except BrokenProcessPool:
+                logger.warning("⚠️ Detection pool crashed, restarting it and running this stage inline")
+                shutdown_detection_pool()
+        return FRAME_STAGES[stage](self.array, *args)
+
+    def detect(self, deduplicate=True, regions=None, upsample=1):
+        return self._run("detect", deduplicate, regions, upsample)
+
+    def encode(self, face_locations, landmarks="small"):
+        return list(self._run("encode", list(face_locations), landmarks))
+
+def warm_up_detector():
+    """Run a dummy detect+encode so dlib's first-call overhead is paid before real frames.
+
+    With a worker pool, one warmup per worker is submitted concurrently so
+    each process loads its models.
+    """
+    frame = np.zeros((120, 160, 3), dtype=np.uint8)
+    location = (30, 110, 90, 50)
+    
+    def warm_once(_=None):
+        with SharedFrame(frame) as shared:
+            shared.detect(deduplicate=False)
+            shared.encode([location])
+    
+    if get_detection_pool() is None:
+        warm_once()
+    else:
+        with ThreadPoolExecutor(max_workers=DETECTION_WORKERS) as executor:
+            list(executor.map(warm_once, range(DETECTION_WORKERS)))
+
+def _run_warmup():
+    try:
+        startup_state.enter("importing")
+        load_face_recognition()
+        startup_state.enter("loading_gallery")
+        load_reference_data(progress=startup_state.set_progress)
+        start_shared_gallery_follower()
+        startup_state.enter("warming_up")
+        warm_up_detector()
+        startup_state.enter("ready")
+        timings = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_state.snapshot()["phase_seconds"].items())
+        logger.info(f"✅ Ready {startup_state.ready_after:.2f}s after start ({timings})")
+    except Exception as e:
+        logger.exception(f"❌ Startup failed: {e}")
+        startup_state.fail(e)
+
+def start_warmup():
+    """Import face_recognition, load the gallery and warm the detector on a background thread (once)."""
+    with startup_state.lock:
+        if startup_state.started:
+            return
+        startup_state.started = True
+    threading.Thread(target=_run_warmup, name="warmup", daemon=True).start()
+
+def warming_up_response():
+    """503 payload for frame requests that arrive before the gallery is loaded, or None once it is.
+
+    Starts warmup if nothing has yet (WSGI servers never run the __main__
+    block); in-process callers opt out with startup_state.skip().
+    """
+    start_warmup()
+    payload = startup_state.not_ready_payload()
+    if payload is not None:
+        return jsonify(payload), 503
+    return None
+
+def scale_location(location, factor=4):
+    """Map a location on the downscaled frame back to full-frame pixels."""
+    return tuple(int(round(v * factor)) for v in location)
+
+def frame_thumbnail(rgb_small_frame):
+    """Tiny grayscale thumbnail used for cheap motion checks."""
+    gray = cv2.cvtColor(rgb_small_frame, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+def _merge_regions(regions):
+    """Union overlapping (top, right, bottom, left) regions so no pixel is scanned twice."""
+    merged = [list(region) for region in regions]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] < b[2] and b[0] < a[2] and a[3] < b[1] and b[3] < a[1]:
+                    merged[i] = [min(a[0], b[0]), max(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3])]
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return [tuple(region) for region in merged]
+
+def prepare_detection_frame(session, frame):
+    """Downscale a BGR frame to RGB at the session's current quality settings.
+
+    Returns (rgb_small_frame, settings); settings["factor"] maps small-frame
+    coordinates back to the full frame.
+    """
+    settings = session.quality.settings()
+    with timed_stage("resize"):
+        small_frame = cv2.resize(frame, (0, 0), fx=settings["scale"], fy=settings["scale"])
+        return cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB), settings
+
+def plan_detection_regions(session, rgb_small_frame, factor=4, thumbnail=None, force_full_sweep=False):
+    """Choose where to run the detector on this frame.
+
+    Returns None for a full-frame sweep, or padded regions (downscaled
+    coordinates) around each tracker's predicted location. A full sweep runs
+    when ROI detection is off, there are no trackers, ROI_FULL_SWEEP_INTERVAL
+    frames have passed, the thumbnail shows motion outside every region, or
+    force_full_sweep is set (quality probe frames).
+    """
+    height, width = rgb_small_frame.shape[:2]
+    if thumbnail is None:
+        thumbnail = frame_thumbnail(rgb_small_frame)
+    previous_thumbnail = session.previous_thumbnail
+    session.previous_thumbnail = thumbnail
+    
+    regions = []
+    if ROI_DETECTION and len(session.face_tracker):
+        # Every tracker's predicted box, padded and clipped on the downscaled frame in one pass
+        predicted = (session.face_tracker.predicted_locations() / factor).astype(np.int64)
+        pad_y = ((predicted[:, 2] - predicted[:, 0]) * ROI_PADDING).astype(np.int64)
+        pad_x = ((predicted[:, 1] - predicted[:, 3]) * ROI_PADDING).astype(np.int64)
+        padded = np.stack((
+            np.maximum(0, predicted[:, 0] - pad_y),
+            np.minimum(width, predicted[:, 1] + pad_x),
+            np.minimum(height, predicted[:, 2] + pad_y),
+            np.maximum(0, predicted[:, 3] - pad_x),
+        ), axis=1)
+        visible = (padded[:, 2] > padded[:, 0]) & (padded[:, 1] > padded[:, 3])
+        regions = _merge_regions(padded[visible].tolist())
+    
+    full_sweep = force_full_sweep or not regions or session.frames_since_full_sweep + 1 >= ROI_FULL_SWEEP_INTERVAL
+    if not full_sweep and previous_thumbnail is not None and previous_thumbnail.shape == thumbnail.shape:
+        moving = np.abs(thumbnail - previous_thumbnail) > ROI_MOTION_PIXEL_DELTA
+        covered = np.zeros_like(moving)
+        scale_y, scale_x = THUMBNAIL_SIZE[1] / height, THUMBNAIL_SIZE[0] / width
+        for top, right, bottom, left in regions:
+            covered[int(top * scale_y):int(np.ceil(bottom * scale_y)), int(left * scale_x):int(np.ceil(right * scale_x))] = True
+        full_sweep = (moving & ~covered).mean() > ROI_MOTION_TRIGGER
+    
+    if full_sweep:
+        session.frames_since_full_sweep = 0
+        session.record_detection_stats("full", height * width, height * width)
+        return None
+    session.frames_since_full_sweep += 1
+    session.record_detection_stats("roi", sum((b - t) * (r - l) for t, r, b, l in regions), height * width)
+    return regions
+
+def scene_unchanged(session, thumbnail):
+    """True if the frame can skip detection because the scene matches the last detected frame.
+
+    Compares thumbnail with the one taken when the detector last ran, so slow
+    drift still adds up to a change. A detection is forced after
+    FRAME_GATE_MAX_SKIPS skipped frames. Skipped frames count toward each
+    tracker's frames_since_verified, and nothing is skipped once a tracker is
+    due for re-verification, so a static scene still re-encodes every
+    confirmed face at least every REVERIFY_INTERVAL_FRAMES frames. Nothing is
+    skipped while a named tracker still awaits confirmation either.
+    """
+    reference = session.previous_thumbnail
+    store = session.face_tracker
+    rows = store.rows()
+    skip = (
+        FRAME_GATING
+        and reference is not None
+        and reference.shape == thumbnail.shape
+        and session.skipped_in_a_row < FRAME_GATE_MAX_SKIPS
+        and (np.abs(thumbnail - reference) > ROI_MOTION_PIXEL_DELTA).mean() <= FRAME_GATE_CHANGE_RATIO
+        and not any(tracker.name != "Unknown" for tracker, confirmed in zip(store.values(), store.confirmed[rows]) if not confirmed)
+        and not (store.frames_since_verified[rows] >= REVERIFY_INTERVAL_FRAMES).any()
+    )
+    session.gate_checks += 1
+    if skip:
+        store.frames_since_verified[rows] += 1
+        session.frames_skipped += 1
+        session.skipped_in_a_row += 1
+    else:
+        session.skipped_in_a_row = 0
+    metrics.count_gate(skip)
+    return skip
+
+def gate_detection_frame(session, rgb_small_frame):
+    """Return (skip, thumbnail) for a downscaled frame; a skipped frame is recorded as scanning no pixels."""
+    with timed_stage("gate"):
+        thumbnail = frame_thumbnail(rgb_small_frame)
+        skip = scene_unchanged(session, thumbnail)
+    if skip:
+        height, width = rgb_small_frame.shape[:2]
+        session.record_detection_stats("skipped", 0, height * width)
+        session.record_encoding_stats(0, 0)
+    return skip, thumbnail
+
+def associate_detections(face_tracker, scaled_locations):
+    """Optimally pair detections with trackers over a batched cost matrix.
+
+    Cost is center distance discounted by box overlap; pairs whose center
+    distance reaches FACE_DISTANCE_THRESHOLD are never assigned. Returns a
+    list aligned with scaled_locations holding a tracker id or None.
+    """
+    assignments = [None] * len(scaled_locations)
+    if not scaled_locations or not face_tracker:
+        return assignments
     
     tracker_ids = list(face_tracker.keys())
-    merged_ids = set()
+    tracker_locations = face_tracker.boxes[face_tracker.rows()]
+    distances = pairwise_center_distances(scaled_locations, tracker_locations)
+    allowed = distances < FACE_DISTANCE_THRESHOLD
+    if not allowed.any():
+        return assignments
     
-    for i, tracker_id_1 in enumerate(tracker_ids):
-        if tracker_id_1 in merged_ids:
-            continue
-            
-        tracker_1 = face_tracker.get(tracker_id_1)
-        if not tracker_1 or tracker_1.name == "Unknown":
-            continue
+    cost = distances * (1 - ASSIGNMENT_IOU_WEIGHT * pairwise_iou(scaled_locations, tracker_locations))
+    # Gated pairs get a cost no valid assignment can beat, then are filtered out below
+    cost[~allowed] = FACE_DISTANCE_THRESHOLD * (len(scaled_locations) + len(tracker_ids) + 1)
+    rows, cols = linear_sum_assignment(cost)
+    for row, col in zip(rows, cols):
+        if allowed[row, col]:
+            assignments[row] = tracker_ids[col]
+    return assignments
+
+def detect_and_identify(session, rgb_small_frame, settings, deduplicate=True, thumbnail=None):
+    """Detect faces and encode only those whose identity is not cached.
+
+    Detections that land on a confirmed tracker, which was verified within
+    REVERIFY_INTERVAL_FRAMES and has not jumped, reuse that tracker's identity
+    and get None in place of an encoding. settings come from
+    prepare_detection_frame(); thumbnail, if already computed, saves redoing
+    it. Returns (face_locations, face_encodings, assignments).
+    """
+    started = time.perf_counter()
+    factor = settings["factor"]
+    regions = plan_detection_regions(session, rgb_small_frame, factor, thumbnail, settings.get("probe", False))
+    with SharedFrame(rgb_small_frame) as shared:
+        with timed_stage("hog"):
+            face_locations = shared.detect(deduplicate, regions, settings["upsample"])
+        scaled_locations = [scale_location(loc, factor) for loc in face_locations]
+        assignments = associate_detections(session.face_tracker, scaled_locations)
         
-        for tracker_id_2 in tracker_ids[i+1:]:
-            if tracker_id_2 in merged_ids:
-                continue
-                
-            tracker_2 = face_tracker.get(tracker_id_2)
-            if not tracker_2:
-                continue
-            
-            # Check if same name and close distance
-            if tracker_1.name == tracker_2.name:
-                distance = calculate_distance(tracker_1.location, tracker_2.location)
-                
-                if distance < TRACKER_MERGE_THRESHOLD:
-                    # Keep the tracker with higher confidence, remove the other
-                    conf_1 = np.mean(tracker_1.confidence_history) if tracker_1.confidence_history else 0
-                    conf_2 = np.mean(tracker_2.confidence_history) if tracker_2.confidence_history else 0
-                    
-                    if conf_1 >= conf_2:
-                        print(f"   Merging duplicate tracker {tracker_id_2} into {tracker_id_1} (distance: {distance:.0f}px)")
-                        del face_tracker[tracker_id_2]
-                        merged_ids.add(tracker_id_2)
-                    else:
-                        print(f"   Merging duplicate tracker {tracker_id_1} into {tracker_id_2} (distance: {distance:.0f}px)")
-                        del face_tracker[tracker_id_1]
-                        merged_ids.add(tracker_id_1)
-                        break
+        to_encode = []
+        for i, tracker_id in enumerate(assignments):
+            tracker = session.face_tracker.get(tracker_id) if tracker_id is not None else None
+            if not (IDENTITY_CACHING and tracker is not None and tracker.can_reuse_identity(scaled_locations[i])):
+                to_encode.append(i)
+        
+        face_encodings = [None] * len(face_locations)
+        if to_encode:
+            with timed_stage("encode"):
+                new_encodings = shared.encode([face_locations[i] for i in to_encode], settings["landmarks"])
+            for i, encoding in zip(to_encode, new_encodings):
+                face_encodings[i] = encoding
+    
+    session.record_encoding_stats(len(face_locations), len(to_encode))
+    session.quality.observe((time.perf_counter() - started) * 1000, [bottom - top for top, _, bottom, _ in scaled_locations],
+                            settings.get("probe", False))
+    return face_locations, face_encodings, assignments
 
-def match_faces_to_trackers(face_locations, face_encodings):
-    """Match detected faces to existing trackers or create new ones."""
-    global face_tracker, next_face_id, known_face_encodings, known_face_names
+def merge_duplicate_trackers(session):
+    """Merge duplicate trackers with the same name that are close to each other."""
+    face_tracker = session.face_tracker
     
-    scaled_locations = []
-    for (top, right, bottom, left) in face_locations:
-        scaled_locations.append((top * 4, right * 4, bottom * 4, left * 4))
+    tracker_ids = list(face_tracker.keys())
+    if len(tracker_ids) < 2:
+        return
+    # Only names held by more than one tracker can produce duplicates
+    name_counts = {}
+    for tracker_id in tracker_ids:
+        name = face_tracker[tracker_id].name
+        name_counts[name] = name_counts.get(name, 0) + 1
+    tracker_ids = [t for t in tracker_ids if face_tracker[t].name != "Unknown" and name_counts[face_tracker[t].name] > 1]
+    if len(tracker_ids) < 2:
+        return
+    trackers = [face_tracker[tracker_id] for tracker_id in tracker_ids]
+    rows = face_tracker.rows(tracker_ids)
     
-    matched_trackers = set()
-    new_detections = []
+    # Find every same-name, in-range pair in one vectorized pass
+    name_codes = {}
+    codes = np.array([name_codes.setdefault(tracker.name, len(name_codes)) for tracker in trackers])
+    locations = face_tracker.boxes[rows]
+    distances = pairwise_center_distances(locations, locations)
+    candidates = (codes[:, None] == codes[None, :]) & (distances < TRACKER_MERGE_THRESHOLD)
+    pairs = np.argwhere(np.triu(candidates, k=1))
+    if len(pairs) == 0:
+        return
+    confidences = face_tracker.mean_confidences(rows)
     
-    for i, location in enumerate(scaled_locations):
-        best_tracker = None
-        min_distance = float('inf')
-        
-        for tracker_id, tracker in face_tracker.items():
-            if tracker_id in matched_trackers:
-                continue
-            distance = calculate_distance(location, tracker.location)
-            if distance < FACE_DISTANCE_THRESHOLD and distance < min_distance:
-                min_distance = distance
-                best_tracker = tracker_id
-        
-        if best_tracker is not None:
-            name = "Unknown"
-            confidence = None
-            
-            if i < len(face_encodings) and known_face_encodings:
-                matches = face_recognition.compare_faces(known_face_encodings, face_encodings[i], tolerance=TRACKING_THRESHOLD)
-                face_distances = face_recognition.face_distance(known_face_encodings, face_encodings[i])
-                
-                if len(face_distances) > 0:
-                    best_match_index = np.argmin(face_distances)
-                    if matches[best_match_index]:
-                        name = known_face_names[best_match_index]
-                        confidence = 1 - face_distances[best_match_index]
-            
-            face_tracker[best_tracker].update_location(location, confidence)
-            face_tracker[best_tracker].name = name
-            matched_trackers.add(best_tracker)
+    # Resolve pairs in the same order as a pairwise scan, keeping the more confident tracker
+    merged = set()
+    for i, j in pairs:
+        if i in merged or j in merged:
+            continue
+        if confidences[i] >= confidences[j]:
+            logger.debug(f"Merging duplicate tracker {tracker_ids[j]} into {tracker_ids[i]} (distance: {distances[i, j]:.0f}px)")
+            merged.add(j)
         else:
-            new_detections.append((location, face_encodings[i] if i < len(face_encodings) else None))
-    
-    for location, encoding in new_detections:
-        name = "Unknown"
-        confidence = None
+            logger.debug(f"Merging duplicate tracker {tracker_ids[i]} into {tracker_ids[j]} (distance: {distances[i, j]:.0f}px)")
+            merged.add(i)
+    for index in merged:
+        del face_tracker[tracker_ids[index]]
+
+def report_confirmed_students(session):
+    """Log one attendance event per student the first time one of their trackers is confirmed in the session."""
+    for tracker in session.face_tracker.values():
+        if not tracker.is_confirmed or tracker.name == "Unknown" or tracker.reported_name == tracker.name:
+            continue
+        tracker.reported_name = tracker.name
+        if tracker.name in session.confirmed_names:
+            continue
+        session.confirmed_names.add(tracker.name)
+        attendance_events.record(session.id, tracker.name, tracker.id, tracker.mean_confidence())
+        logger.info(f"✅ {tracker.name} confirmed in session {session.id}")
+
+def match_faces_to_trackers(session, face_locations, face_encodings, assignments=None, factor=4):
+    """Match detected faces to the session's trackers or create new ones.
+
+    A None encoding means the detection reuses its tracker's cached identity.
+    assignments, if given, is the output of associate_detections(); factor
+    maps face_locations back to full-frame pixels.
+    """
+    with timed_stage("match"):
+        face_tracker = session.face_tracker
         
-        if encoding is not None and known_face_encodings:
-            matches = face_recognition.compare_faces(known_face_encodings, encoding, tolerance=TRACKING_THRESHOLD)
-            face_distances = face_recognition.face_distance(known_face_encodings, encoding)
-            
-            if len(face_distances) > 0:
-                best_match_index = np.argmin(face_distances)
-                if matches[best_match_index]:
-                    name = known_face_names[best_match_index]
-                    confidence = 1 - face_distances[best_match_index]
-        
-        tracker = FaceTracker(next_face_id, name, location, encoding)
-        if confidence is not None:
-            tracker.update_location(location, confidence)
-        face_tracker[next_face_id] = tracker
-        next_face_id += 1
-    
-    for tracker_id in list(face_tracker.keys()):
-        if tracker_id not in matched_trackers:
-            face_tracker[tracker_id].increment_missed_frames()
-            if face_tracker[tracker_id].is_expired():
-                del face_tracker[tracker_id]
+        # Identify every freshly encoded detection in the frame with a single gallery pass
+        encoded_ids = [i for i, encoding in enumerate(face_encodings) if encoding is not None]
+        identities = [("Unknown", None)] * len(face_locations)
+        for i, identity in zip(encoded_ids, match_encodings_for_session(session, [face_encodings[i] for i in encoded_ids])):
+            identities[i] = identity
+        
+        scaled_locations = [scale_location(loc, factor) for loc in face_locations]
+        if assignments is None:
+            assignments = associate_detections(face_tracker, scaled_locations)
+        
+        matched_rows = []
+        matched_locations = []
+        matched_confidences = []
+        verified = []
+        new_detections = []
+        
+        for i, location in enumerate(scaled_locations):
+            best_tracker = assignments[i]
+            encoding = face_encodings[i] if i < len(face_encodings) else None
+            name, confidence = identities[i]
+        
+            if best_tracker is not None:
+                tracker = face_tracker[best_tracker]
+                matched_rows.append(tracker.row)
+                matched_locations.append(location)
+                if encoding is None and IDENTITY_CACHING and tracker.is_confirmed:
+                    # Cached identity: only the box moves
+                    matched_confidences.append(None)
+                    verified.append(False)
+                else:
+                    if encoding is not None:
+                        tracker.encoding = encoding
+                    tracker.name = name
+                    matched_confidences.append(confidence)
+                    verified.append(True)
+            else:
+                new_detections.append((location, encoding, name, confidence))
+        
+        # Smooth every matched tracker at once
+        if matched_rows:
+            matched_rows = np.array(matched_rows)
+            face_tracker.update(matched_rows, matched_locations, matched_confidences)
+            verified = np.array(verified)
+            face_tracker.frames_since_verified[matched_rows[~verified]] += 1
+            face_tracker.frames_since_verified[matched_rows[verified]] = 0
+        
+        for location, encoding, name, confidence in new_detections:
+            tracker = face_tracker.add(session.next_face_id, name, location, encoding)
+            if confidence is not None:
+                tracker.update_location(location, confidence)
+            session.next_face_id += 1
+        
+        # Predict and expire everything left unmatched in one pass
+        missed = np.ones(len(face_tracker), dtype=bool)
+        missed[matched_rows] = False
+        face_tracker.mark_missed(np.flatnonzero(missed))
+        face_tracker.remove_expired()
+    
+    if session.record_events:
+        report_confirmed_students(session)
     
     # After matching, merge any duplicate trackers
-    merge_duplicate_trackers()
+    with timed_stage("merge"):
+        merge_duplicate_trackers(session)
 
-@app.route('/api/camera/list', methods=['GET'])
-def list_cameras():
-    """List all available cameras."""
-    available_cameras = []
-    
-    # Test up to 10 camera indices
-    for i in range(10):
-        try:
-            cap = cv2.VideoCapture(i)
-            if cap.isOpened():
-                # Try to read a frame to confirm the camera is working
-                ret, frame = cap.read()
-                if ret:
-                    available_cameras.append({
+@app.route('/api/gallery/reload', methods=['POST'])
+def reload_gallery_endpoint():
+    """Re-scan photos/, encode only added or changed photos and swap in the new gallery."""
+    if GALLERY_ADMIN_TOKEN and request.headers.get('X-Admin-Token') != GALLERY_ADMIN_TOKEN:
+        return jsonify({"status": "error", "message": "Invalid admin token"}), 403
+    try:
+        stats = sync_gallery()
+    except Exception as e:
+        logger.exception(f"❌ Gallery reload failed: {e}")
+        return jsonify({"status": "error", "message": f"Gallery reload failed: {str(e)}"})
+    logger.info(f"🔄 Gallery reloaded: {stats['added']} added, {stats['changed']} changed, {stats['removed']} removed ({stats['gallery_size']} faces)")
+    return jsonify({"status": "success", "changes": stats, "gallery": gallery_index.stats()})
+
+@app.route('/api/gallery/stats', methods=['GET'])
+def gallery_stats():
+    """Report the active gallery index configuration and its measured recall."""
+    return jsonify({"status": "success", "gallery": gallery_index.stats(), "rosters": roster_galleries.stats()})
+
+class CameraRegistry:
+    """Cached list of camera devices, refreshed in the background once it is older than CAMERA_REGISTRY_TTL.
+
+    Probing opens each device index and reads a frame, which takes hundreds
+    of milliseconds per device, so requests read the cached list instead.
+    The index held by the running camera stream is reported without being
+    reopened, and probe_lock keeps a scan from racing a camera start.
+    """
+    def __init__(self):
+        self.cameras = []
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+        self.probe_lock = threading.Lock()  # Held while any VideoCapture is being opened
+        self.refreshing = False
+        self.scan_finished = None  # Set when the running background scan completes
+
+    def refresh(self):
+        """Probe the device indices now and return the new camera list.
+
+        If a background scan is already running, waits for it instead of
+        probing every device a second time.
+        """
+        with self.lock:
+            pending = self.scan_finished if self.refreshing else None
+        if pending is not None:
+            pending.wait()
+            with self.lock:
+                return self.cameras
+        return self._probe()
+
+    def _probe(self):
+        with self.probe_lock:
+            stream = active_camera_stream()
+            active_index = stream.camera_index if stream is not None else None
+            cameras = []
+            for i in range(CAMERA_PROBE_INDICES):
+                if i == active_index:
+                    cameras.append({
                         "index": i,
                         "name": f"Camera {i}",
-                        "description": f"Camera device at index {i}"
+                        "description": f"Camera device at index {i}",
+                        "in_use": True
                     })
-                cap.release()
-        except Exception:
-            continue
+                    continue
+                try:
+                    cap = cv2.VideoCapture(i)
+                    if cap.isOpened():
+                        # Try to read a frame to confirm the camera is working
+                        ret, frame = cap.read()
+                        if ret:
+                            cameras.append({
+                                "index": i,
+                                "name": f"Camera {i}",
+                                "description": f"Camera device at index {i}",
+                                "in_use": False
+                            })
+                    cap.release()
+                except Exception:
+                    continue
+        with self.lock:
+            self.cameras = cameras
+            self.refreshed_at = time.time()
+        return cameras
+
+    def refresh_in_background(self):
+        """Start a background refresh unless one is already running."""
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+            self.scan_finished = finished = threading.Event()
+        
+        def run():
+            try:
+                self._probe()
+            except Exception as e:
+                logger.error(f"❌ Camera scan failed: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing = False
+                finished.set()
+        
+        threading.Thread(target=run, name="camera-registry", daemon=True).start()
+
+    def mark_in_use(self, camera_index, in_use):
+        """Update the cached entry for a camera that was just started or stopped."""
+        with self.lock:
+            for camera in self.cameras:
+                if camera["index"] == camera_index:
+                    camera["in_use"] = in_use
+                    return
+            if in_use:
+                self.cameras = sorted(self.cameras + [{
+                    "index": camera_index,
+                    "name": f"Camera {camera_index}",
+                    "description": f"Camera device at index {camera_index}",
+                    "in_use": True
+                }], key=lambda camera: camera["index"])
+
+    def snapshot(self):
+        """Return (cameras, age_seconds) without probing; age is None before the first scan.
+
+        Schedules a background refresh when the list is missing or stale.
+        """
+        with self.lock:
+            cameras, refreshed_at = self.cameras, self.refreshed_at
+        age = time.time() - refreshed_at if refreshed_at is not None else None
+        if age is None or age > CAMERA_REGISTRY_TTL:
+            self.refresh_in_background()
+        return cameras, age
+
+camera_registry = CameraRegistry()
+
+@app.route('/api/camera/list', methods=['GET'])
+def list_cameras():
+    """List available cameras from the registry; ?refresh=1 (or no scan yet) probes now."""
+    cameras, age = camera_registry.snapshot()
+    if age is None or request.args.get('refresh') in ('1', 'true'):
+        cameras, age = camera_registry.refresh(), 0.0
     
     return jsonify({
-        "status": "success" if available_cameras else "no_cameras",
-        "cameras": available_cameras,
-        "message": f"Found {len(available_cameras)} camera(s)" if available_cameras else "No cameras detected"
+        "status": "success" if cameras else "no_cameras",
+        "cameras": cameras,
+        "scanned_seconds_ago": round(age, 1),
+        "message": f"Found {len(cameras)} camera(s)" if cameras else "No cameras detected"
     })
 
 @app.route('/api/camera/status', methods=['GET'])
 def camera_status():
-    """Check if camera is available."""
+    """Check if camera is available, answered from the cached registry."""
     try:
-        # Check if any camera is available
-        list_result = list_cameras()
-        data = list_result.get_json()
+        stream = active_camera_stream()
+        cameras, age = camera_registry.snapshot()
         
-        if data["cameras"]:
-            return jsonify({"status": "available", "message": f"Found {len(data['cameras'])} camera(s)"})
+        if stream is not None:
+            return jsonify({"status": "available", "message": f"Camera {stream.camera_index} is active", "active_camera": stream.camera_index})
+        elif cameras:
+            return jsonify({"status": "available", "message": f"Found {len(cameras)} camera(s)"})
+        elif age is None:
+            return jsonify({"status": "unavailable", "message": "Scanning for cameras...", "scanning": True})
         else:
             return jsonify({"status": "unavailable", "message": "No cameras detected"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
 
+class CameraStream:
+    """Background capture and recognition loop for one opened server-side camera.
+
+    The loop reads frames as fast as the camera delivers them, runs
+    recognition on every CAMERA_DETECTION_INTERVAL-th frame, and publishes one
+    annotated JPEG per captured frame. Viewers (MJPEG stream, latest-frame and
+    JSON endpoints) only read the published frame, so adding viewers costs no
+    extra capture, recognition or encoding.
+    """
+    def __init__(self, camera_index, capture, session):
+        self.camera_index = camera_index
+        self.capture = capture
+        self.session = session
+        self.running = False
+        self.thread = None
+        self.frame_ready = threading.Condition()
+        self.sequence = 0
+        self.jpeg = None
+        self.frame_base64 = None  # Encoded lazily for the JSON endpoint, once per published frame
+        self.detected_faces = []
+        self.started_at = time.time()
+        self.frames_captured = 0
+        self.read_failures = 0
+        self.avg_loop_ms = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"camera-{self.camera_index}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2.0)
+        self.capture.release()
+
+    def _run(self):
+        consecutive_failures = 0
+        while self.running:
+            ret, frame = self.capture.read()
+            if not ret:
+                self.read_failures += 1
+                consecutive_failures += 1
+                if consecutive_failures >= CAMERA_MAX_READ_FAILURES:
+                    logger.error(f"❌ Camera {self.camera_index} stopped delivering frames; stopping capture loop")
+                    self.running = False
+                    break
+                time.sleep(CAMERA_READ_RETRY_DELAY)
+                continue
+            consecutive_failures = 0
+            
+            started = time.perf_counter()
+            with self.session.lock:
+                detected_faces = _annotate_camera_frame(self.session, frame)
+            ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, CAMERA_JPEG_QUALITY])
+            if not ok:
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            
+            with self.frame_ready:
+                self.frames_captured += 1
+                self.sequence += 1
+                self.jpeg = buffer.tobytes()
+                self.frame_base64 = None
+                self.detected_faces = detected_faces
+                self.avg_loop_ms += PROCESSING_TIME_SMOOTHING * (elapsed_ms - self.avg_loop_ms)
+                self.frame_ready.notify_all()
+        
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+
+    def latest(self):
+        """Return (sequence, jpeg_bytes, detected_faces) for the newest published frame."""
+        with self.frame_ready:
+            return self.sequence, self.jpeg, self.detected_faces
+
+    def latest_base64(self):
+        """Return (sequence, base64_jpeg, detected_faces), encoding at most once per frame."""
+        with self.frame_ready:
+            if self.jpeg is not None and self.frame_base64 is None:
+                self.frame_base64 = base64.b64encode(self.jpeg).decode('utf-8')
+            return self.sequence, self.frame_base64, self.detected_faces
+
+    def wait_for_frame(self, after_sequence, timeout=CAMERA_STREAM_WAIT_TIMEOUT):
+        """Block until a frame newer than after_sequence is published.
+
+        Returns (sequence, jpeg_bytes), or None if the stream stopped or
+        timed out.
+        """
+        with self.frame_ready:
+            self.frame_ready.wait_for(lambda: not self.running or self.sequence > after_sequence, timeout)
+            if self.sequence <= after_sequence:
+                return None
+            return self.sequence, self.jpeg
+
+    def stats(self):
+        uptime = max(time.time() - self.started_at, 1e-6)
+        return {
+            "camera_index": self.camera_index,
+            "running": self.running,
+            "frames_captured": self.frames_captured,
+            "read_failures": self.read_failures,
+            "capture_fps": round(self.frames_captured / uptime, 1),
+            "avg_loop_ms": round(self.avg_loop_ms, 1),
+        }
+
+def active_camera_stream():
+    """Return the running CameraStream, or None if no camera is open."""
+    stream = camera_stream
+    if stream is None or not stream.running:
+        return None
+    return stream
+
 @app.route('/api/camera/start', methods=['POST'])
 def start_camera():
     """Start camera for facial recognition."""
-    global video_capture, camera_on, face_tracker
-    
-    if camera_on:
-        return jsonify({"status": "already_running", "message": "Camera is already active"})
+    global camera_stream
     
-    try:
-        # Get camera index from request body, default to 0
-        data = request.get_json() or {}
-        camera_index = data.get('camera_index', 0)
-        
-        print(f"Attempting to start camera at index {camera_index}")
-        
-        video_capture = cv2.VideoCapture(camera_index)
-        if video_capture.isOpened():
-            # Test if we can actually read a frame
-            ret, frame = video_capture.read()
-            if ret:
-                video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-                video_capture.set(cv2.CAP_PROP_FPS, 30)
-                camera_on = True
-                face_tracker.clear()
-                return jsonify({
-                    "status": "started", 
-                    "message": f"Camera {camera_index} started successfully",
-                    "camera_index": camera_index
-                })
+    # probe_lock keeps a background scan from opening the device while it is being claimed
+    with camera_stream_lock, camera_registry.probe_lock:
+        if active_camera_stream() is not None:
+            return jsonify({"status": "already_running", "message": "Camera is already active"})
+        if camera_stream is not None:
+            camera_stream.stop()  # Loop ended on its own (camera unplugged); release it before reopening
+            camera_stream = None
+        
+        video_capture = None
+        try:
+            # Get camera index from request body, default to 0
+            data = request.get_json(silent=True) or {}
+            camera_index = data.get('camera_index', 0)
+            
+            logger.info(f"Attempting to start camera at index {camera_index}")
+            
+            video_capture = cv2.VideoCapture(camera_index)
+            if video_capture.isOpened():
+                # Test if we can actually read a frame
+                ret, frame = video_capture.read()
+                if ret:
+                    video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+                    video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+                    video_capture.set(cv2.CAP_PROP_FPS, 30)
+                    video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Keep latency low when recognition lags capture
+                    with camera_session.lock:
+                        camera_session.reset()
+                    camera_stream = CameraStream(camera_index, video_capture, camera_session)
+                    camera_stream.start()
+                    camera_registry.mark_in_use(camera_index, True)
+                    return jsonify({
+                        "status": "started", 
+                        "message": f"Camera {camera_index} started successfully",
+                        "camera_index": camera_index
+                    })
+                else:
+                    video_capture.release()
+                    return jsonify({"status": "error", "message": f"Camera {camera_index} detected but cannot read frames"})
             else:
+                return jsonify({"status": "error", "message": f"Could not access camera at index {camera_index}"})
+        except Exception as e:
+            if video_capture:
                 video_capture.release()
-                return jsonify({"status": "error", "message": f"Camera {camera_index} detected but cannot read frames"})
-        else:
-            return jsonify({"status": "error", "message": f"Could not access camera at index {camera_index}"})
-    except Exception as e:
-        if video_capture:
-            video_capture.release()
-        return jsonify({"status": "error", "message": str(e)})
+            return jsonify({"status": "error", "message": str(e)})
 
 @app.route('/api/camera/stop', methods=['POST'])
 def stop_camera():
     """Stop camera."""
-    global video_capture, camera_on, face_tracker
+    global camera_stream
     
-    camera_on = False
-    if video_capture:
-        video_capture.release()
-        video_capture = None
-    face_tracker.clear()
+    with camera_stream_lock:
+        if camera_stream is not None:
+            camera_stream.stop()
+            camera_registry.mark_in_use(camera_stream.camera_index, False)
+            camera_stream = None
+    with camera_session.lock:
+        camera_session.reset()
     
     return jsonify({"status": "stopped", "message": "Camera stopped successfully"})
 
 @app.route('/api/camera/frame', methods=['GET'])
 def get_frame():
-    """Get current frame with face recognition annotations."""
-    global video_capture, camera_on, frame_count
-    
-    if not camera_on or video_capture is None or not video_capture.isOpened():
+    """Get the latest annotated frame (base64 JPEG) and detected faces as JSON."""
+    stream = active_camera_stream()
+    if stream is None:
         return jsonify({"status": "error", "message": "Camera is not active"})
     
-    ret, frame = video_capture.read()
-    if not ret:
-        return jsonify({"status": "error", "message": "Could not read frame from camera"})
+    sequence, frame_base64, detected_faces = stream.latest_base64()
+    if frame_base64 is None:
+        if stream.wait_for_frame(0) is None:
+            return jsonify({"status": "error", "message": "Could not read frame from camera"})
+        sequence, frame_base64, detected_faces = stream.latest_base64()
+    
+    return jsonify({
+        "status": "success",
+        "frame": frame_base64,
+        "sequence": sequence,
+        "detected_faces": detected_faces,
+        "total_faces": len(detected_faces)
+    })
+
+@app.route('/api/camera/latest.jpg', methods=['GET'])
+def get_latest_frame():
+    """Return the latest annotated frame as a plain JPEG."""
+    stream = active_camera_stream()
+    if stream is None:
+        return jsonify({"status": "error", "message": "Camera is not active"}), 503
+    
+    sequence, jpeg, _ = stream.latest()
+    if jpeg is None:
+        published = stream.wait_for_frame(0)
+        if published is None:
+            return jsonify({"status": "error", "message": "Could not read frame from camera"}), 503
+        sequence, jpeg = published
+    
+    return Response(jpeg, mimetype='image/jpeg', headers={"X-Frame-Sequence": str(sequence), "Cache-Control": "no-store"})
+
+@app.route('/api/camera/stream', methods=['GET'])
+def camera_mjpeg_stream():
+    """Stream annotated frames as MJPEG (multipart/x-mixed-replace), usable directly in an <img> tag."""
+    stream = active_camera_stream()
+    if stream is None:
+        return jsonify({"status": "error", "message": "Camera is not active"}), 503
+    
+    def generate():
+        last_sequence = 0
+        while True:
+            published = stream.wait_for_frame(last_sequence)
+            if published is None:
+                if not stream.running:
+                    break
+                continue
+            last_sequence, jpeg = published
+            yield (b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(jpeg)).encode() +
+                   b"\r\n\r\n" + jpeg + b"\r\n")
     
-    frame_count += 1
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame', headers={"Cache-Control": "no-store"})
+
+def _annotate_camera_frame(session, frame):
+    """Run recognition on a server-side camera frame, draw annotations in place and return the detected faces."""
+    face_tracker = session.face_tracker
+    session.frame_count += 1
+    frame_count = session.frame_count
     
-    # Process face detection every 3rd frame
-    if frame_count % 3 == 0:
+    # Process face detection every Nth frame
+    if frame_count % CAMERA_DETECTION_INTERVAL == 0:
         try:
-            small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-            rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-            
-            face_locations = face_recognition.face_locations(rgb_small_frame)
-            current_face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+            rgb_small_frame, settings = prepare_detection_frame(session, frame)
             
-            match_faces_to_trackers(face_locations, current_face_encodings)
+            skip, thumbnail = gate_detection_frame(session, rgb_small_frame)
+            if skip:
+                # Nothing moved since the last detection, so the frames in between were not misses either
+                face_tracker.forgive_misses(session.frames_since_detection)
+            else:
+                face_locations, current_face_encodings, assignments = detect_and_identify(session, rgb_small_frame, settings, deduplicate=False, thumbnail=thumbnail)
+                
+                match_faces_to_trackers(session, face_locations, current_face_encodings, assignments, settings["factor"])
         except Exception as e:
-            print(f"Error during face recognition: {e}")
+            logger.exception(f"Error during face recognition: {e}")
+        session.frames_since_detection = 0
     else:
-        for tracker in face_tracker.values():
-            tracker.increment_missed_frames()
+        face_tracker.mark_missed()
+        session.frames_since_detection += 1
     
     # Draw face annotations
     for tracker_id, tracker in list(face_tracker.items()):
@@ -472,9 +2594,8 @@ def get_frame():
         
         # Prepare label text
         label = tracker.name
-        if tracker.confidence_history:
-            avg_confidence = np.mean(tracker.confidence_history)
-            label += f" ({avg_confidence:.2f})"
+        if face_tracker.confidence_count[tracker.row]:
+            label += f" ({tracker.mean_confidence():.2f})"
         
         # Draw label background
         cv2.rectangle(frame, (left, bottom - 35), (right, bottom), color, cv2.FILLED)
@@ -486,135 +2607,652 @@ def get_frame():
     info_text = f"Frames: {frame_count} | Active Trackers: {len(face_tracker)}"
     cv2.putText(frame, info_text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
     
-    # Convert frame to base64
-    _, buffer = cv2.imencode('.jpg', frame)
-    frame_base64 = base64.b64encode(buffer).decode('utf-8')
-    
     # Get detected faces info
-    detected_faces = []
-    for tracker_id, tracker in face_tracker.items():
-        if not tracker.is_expired():
-            detected_faces.append({
-                "id": tracker_id,
-                "name": tracker.name,
-                "confidence": np.mean(tracker.confidence_history) if tracker.confidence_history else 0,
-                "is_confirmed": tracker.is_confirmed
-            })
-    
-    return jsonify({
-        "status": "success",
-        "frame": frame_base64,
-        "detected_faces": detected_faces,
-        "total_faces": len(detected_faces)
-    })
+    return [
+        {key: face[key] for key in ("id", "name", "confidence", "is_confirmed")}
+        for face in serialize_trackers(session)
+    ]
 
 @app.route('/api/clear-trackers', methods=['POST'])
 def clear_trackers():
-    """Clear all face trackers (called when camera stops)."""
-    global face_tracker, next_face_id, process_frame_count
+    """Clear the requesting session's face trackers (called when camera stops)."""
+    session_id = request_session_id(request.get_json(silent=True))
+    
+    with tracking_sessions_lock:
+        session = tracking_sessions.pop(session_id, None)
+    if session is not None:
+        with session.lock:
+            session.reset()
+    logger.info(f"Cleared face trackers for session {session_id}")
+    
+    return jsonify({"status": "success", "message": "Face trackers cleared", "session_id": session_id})
+
+@app.route('/api/sessions/roster', methods=['POST'])
+def set_session_roster():
+    """Scope a session to a course roster: {"course_id", "students": [student keys]}; an empty list clears it."""
+    data = request.get_json(silent=True) or {}
+    students = data.get('students')
+    if students is not None and not (isinstance(students, list) and all(isinstance(student, str) for student in students)):
+        return jsonify({"status": "error", "message": "students must be a list of student keys"})
     
-    face_tracker.clear()
-    next_face_id = 0
-    process_frame_count = 0
-    print("Cleared all face trackers and reset frame count")
+    session = get_tracking_session(request_session_id(data))
+    session.set_roster(data.get('course_id'), students)
+    roster = session.roster_stats()
+    if roster is None:
+        logger.info(f"Session {session.id} now matches against the full gallery")
+    else:
+        logger.info(f"📋 Session {session.id} scoped to course {roster['course_id']} ({roster['students']} students, {len(roster['missing_photos'])} without photos)")
+    return jsonify({"status": "success", "session_id": session.id, "roster": roster})
+
+@app.route('/api/sessions', methods=['GET'])
+def list_sessions():
+    """List active tracking sessions."""
+    evict_idle_sessions()
+    with tracking_sessions_lock:
+        sessions = [session.summary() for session in tracking_sessions.values()]
+    return jsonify({"status": "success", "sessions": sessions, "total_sessions": len(sessions)})
+
+@app.route('/api/attendance/events', methods=['GET'])
+def list_attendance_events():
+    """Return "student confirmed" events after the ?since= cursor, optionally for one session_id."""
+    try:
+        since = int(request.args.get('since', 0))
+        limit = max(1, min(int(request.args.get('limit', EVENT_FETCH_LIMIT)), EVENT_FETCH_LIMIT))
+    except ValueError:
+        return jsonify({"status": "error", "message": "since and limit must be integers"})
     
-    return jsonify({"status": "success", "message": "Face trackers cleared"})
+    events = attendance_events.fetch(since, limit, request.args.get('session_id'))
+    return jsonify({
+        "status": "success",
+        "events": events,
+        # Pass this back as ?since= on the next poll
+        "cursor": events[-1]["id"] if events else since,
+        "has_more": len(events) == limit
+    })
+
+@app.route('/healthz', methods=['GET'])
+def liveness():
+    """Liveness: the process is up and serving requests, whether or not warmup has finished."""
+    return jsonify({"status": "alive", "uptime_seconds": round(time.time() - PROCESS_STARTED, 3)})
+
+@app.route('/readyz', methods=['GET'])
+def readiness():
+    """Readiness: 200 once the gallery is loaded and the detector is warm, 503 with load progress before."""
+    start_warmup()  # No-op when already started; lets WSGI deployments warm up on the first probe
+    snapshot = startup_state.snapshot()
+    if startup_state.ready:
+        return jsonify(dict(snapshot, status="ready"))
+    return jsonify(dict(snapshot, status="failed" if snapshot["phase"] == "failed" else "starting")), 503
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Expose stage latency histograms, frame counters and tracker/gallery gauges in Prometheus text format."""
+    with tracking_sessions_lock:
+        sessions = list(tracking_sessions.values())
+    active_trackers = sum(len(session.face_tracker) for session in sessions) + len(camera_session.face_tracker)
+    gauges = {
+        "facial_recognition_active_trackers": ("Live face trackers across all sessions.", active_trackers),
+        "facial_recognition_sessions": ("Active client tracking sessions.", len(sessions)),
+        "facial_recognition_gallery_size": ("Enrolled face encodings in the gallery.", len(known_face_names)),
+        "facial_recognition_frame_skip_ratio": ("Share of detection frames skipped by frame-change gating.", metrics.skip_ratio()),
+    }
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/process-frame', methods=['POST'])
 def process_frame():
     """Process a single frame sent from the browser with face tracking."""
-    global known_face_encodings, known_face_names, face_tracker, next_face_id, process_frame_count
-    
     try:
+        not_ready = warming_up_response()
+        if not_ready:
+            return not_ready
+        
         data = request.get_json()
         if not data or 'frame' not in data:
             return jsonify({"status": "error", "message": "No frame data provided"})
         
-        process_frame_count += 1
-        print(f"Received frame #{process_frame_count} for processing...")
+        session = get_tracking_session(request_session_id(data))
+        try:
+            apply_requested_quality(session, data)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)})
         
         # Decode base64 image
-        frame_data = base64.b64decode(data['frame'])
-        nparr = np.frombuffer(frame_data, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        frame = decode_frame_bytes(base64.b64decode(data['frame']))
         
         if frame is None:
             return jsonify({"status": "error", "message": "Invalid image data"})
         
-        print(f"   Frame size: {frame.shape}")
+        return frame_response(submit_session_frame(session, frame))
+            
+    except Exception as e:
+        logger.exception(f"❌ Frame processing error: {e}")
+        return jsonify({"status": "error", "message": f"Frame processing error: {str(e)}"})
+
+@app.route('/api/process-frame/raw', methods=['POST'])
+def process_frame_raw():
+    """Process an encoded JPEG/PNG sent as application/octet-stream or a multipart "frame" file.
+
+    Skips the base64/JSON round trip; the session id comes from the
+    X-Session-Id header or session_id query parameter.
+    """
+    not_ready = warming_up_response()
+    if not_ready:
+        return not_ready
+    
+    try:
+        if request.files:
+            upload = request.files.get('frame')
+            if upload is None:
+                return jsonify({"status": "error", "message": "No frame file provided"})
+            frame_data = upload.read()
+        else:
+            frame_data = request.get_data(cache=False)
+        if not frame_data:
+            return jsonify({"status": "error", "message": "No frame data provided"})
+        
+        session = get_tracking_session(request_session_id())
+        try:
+            apply_requested_quality(session)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)})
+        frame = decode_frame_bytes(frame_data)
+        if frame is None:
+            return jsonify({"status": "error", "message": "Invalid image data"})
         
-        # Process face detection with tracking
+        return frame_response(submit_session_frame(session, frame))
+            
+    except Exception as e:
+        logger.exception(f"❌ Frame processing error: {e}")
+        return jsonify({"status": "error", "message": f"Frame processing error: {str(e)}"})
+
+if sock is not None:
+    @sock.route('/ws/process-frame')
+    def process_frame_stream(ws):
+        """Stream binary JPEG frames in and tracker results out over one WebSocket.
+
+        Each binary message is one encoded frame; the reply is the same JSON
+        payload /api/process-frame returns. The session id is read from the
+        X-Session-Id header or session_id query parameter at connect time, as
+        is an optional quality profile.
+        """
+        start_warmup()
+        not_ready = startup_state.not_ready_payload()
+        if not_ready is not None:
+            ws.send(json.dumps(not_ready))
+            return
+        session = get_tracking_session(request_session_id())
         try:
-            # Detect on every frame for smooth tracking
-            print(f"   DETECTING faces on frame #{process_frame_count}")
+            apply_requested_quality(session)
+        except ValueError as e:
+            ws.send(json.dumps({"status": "error", "message": str(e)}))
+            return
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            if isinstance(message, str):
+                ws.send(json.dumps({"status": "error", "message": "Send frames as binary messages"}))
+                continue
+            if not message:
+                ws.send(json.dumps({"status": "error", "message": "No frame data provided"}))
+                continue
+            session.touch()
+            frame = decode_frame_bytes(message)
+            if frame is None:
+                ws.send(json.dumps({"status": "error", "message": "Invalid image data"}))
+                continue
+            ws.send(serialize_payload(submit_session_frame(session, frame)))
+
+def decode_frame_bytes(frame_data):
+    """Decode an encoded image straight from its buffer (np.frombuffer does not copy)."""
+    with timed_stage("decode"):
+        return cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
+
+def serialize_payload(payload):
+    """JSON-encode a frame response, timed as the serialize stage."""
+    with timed_stage("serialize"):
+        return json.dumps(payload)
+
+def frame_response(payload):
+    """Build the HTTP response for a frame payload."""
+    return Response(serialize_payload(payload), mimetype='application/json')
+
+def submit_session_frame(session, frame):
+    """Run a frame through the session's latest-frame-wins slot.
+
+    If another frame of this session is being processed, this one waits in
+    the slot; a newer arrival replaces it and the superseded request returns
+    the current tracker state with status "dropped" instead of queueing.
+    """
+    with session.frame_slot:
+        session.frames_received += 1
+        session.in_flight += 1
+        if session.pending_frame is not None:
+            session.frames_dropped += 1
+            session.dropped_since_processed += 1
+        session.frame_sequence += 1
+        sequence = session.frame_sequence
+        session.pending_frame = (sequence, frame)
+        session.frame_slot.notify_all()
+        
+        while True:
+            if session.pending_frame is None or session.pending_frame[0] != sequence:
+                superseded = True
+                break
+            if not session.processing:
+                superseded = False
+                session.pending_frame = None
+                session.processing = True
+                skipped = session.dropped_since_processed
+                session.dropped_since_processed = 0
+                break
+            session.frame_slot.wait()
+    
+    try:
+        if superseded:
+            metrics.count_frame(dropped=True)
+            return {
+                "status": "dropped",
+                "session_id": session.id,
+                "detected_faces": serialize_trackers(session),
+                "scheduler": session.scheduler_stats(),
+                "message": "A newer frame replaced this one before it was processed"
+            }
+        
+        started = time.perf_counter()
+        with session.lock:
+            # Dropped frames still happened in real time; carry trackers forward over them
+            if skipped:
+                session.face_tracker.advance_prediction(skipped)
+            payload = _process_session_frame(session, frame)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        
+        metrics.count_frame()
+        with session.frame_slot:
+            session.frames_processed += 1
+            if session.frames_processed == 1:
+                session.avg_processing_ms = elapsed_ms
+            else:
+                session.avg_processing_ms += PROCESSING_TIME_SMOOTHING * (elapsed_ms - session.avg_processing_ms)
+        payload["scheduler"] = session.scheduler_stats()
+        return payload
+    finally:
+        with session.frame_slot:
+            session.in_flight -= 1
+            if not superseded:
+                session.processing = False
+            session.frame_slot.notify_all()
 
-            # Resize frame to 1/4 resolution for faster processing (face_recognition recommendation)
-            small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-            rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+def serialize_trackers(session):
+    """Snapshot the session's live trackers in the /api/process-frame response shape."""
+    store = session.face_tracker
+    trackers = list(store.values())
+    rows = np.fromiter((tracker.row for tracker in trackers), dtype=np.intp, count=len(trackers))
+    live = ~store.expired(rows)
+    boxes = store.boxes[rows].tolist()
+    confidences = store.mean_confidences(rows).tolist()
+    confirmed = store.confirmed[rows].tolist()
+    detected_faces = []
+    for i in np.flatnonzero(live):
+        top, right, bottom, left = boxes[i]
+        detected_faces.append({
+            "id": trackers[i].id,
+            "name": trackers[i].name,
+            "confidence": confidences[i],
+            "is_confirmed": confirmed[i],
+            "location": {"top": top, "right": right, "bottom": bottom, "left": left}
+        })
+    return detected_faces
 
-            print(f"   Processing frame size: {small_frame.shape}")
+def _process_session_frame(session, frame):
+    """Detect, encode and track faces in a decoded frame; caller holds session.lock.
 
-            # Find faces using HOG model and deduplicate overlapping detections
-            face_locations = face_recognition.face_locations(rgb_small_frame, model="hog")
-            print(f"   Raw HOG detections: {len(face_locations)}")
-            face_locations = smooth_face_locations(face_locations)
-            face_locations = deduplicate_face_locations(face_locations)
-            print(f"   After smoothing & deduplication: {len(face_locations)}")
+    Returns the JSON-serializable response payload.
+    """
+    face_tracker = session.face_tracker
+    session.frame_count += 1
+    process_frame_count = session.frame_count
+    debug = logger.isEnabledFor(logging.DEBUG)
+    
+    # Process face detection with tracking
+    try:
+        # Downscale at the session's quality profile (1/4 resolution when "balanced")
+        rgb_small_frame, settings = prepare_detection_frame(session, frame)
 
-            current_face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
-            print(f"   Generated {len(current_face_encodings)} face encoding(s)")
+        # A static scene (e.g. during a quiz) keeps its trackers as they are without touching dlib
+        skip, thumbnail = gate_detection_frame(session, rgb_small_frame)
+        if skip:
+            if debug:
+                logger.debug(f"Frame #{process_frame_count} for session {session.id}: scene unchanged, detection skipped")
+        else:
+            # Find faces using HOG model, deduplicate overlapping detections and encode the uncached ones
+            face_locations, current_face_encodings, assignments = detect_and_identify(session, rgb_small_frame, settings, thumbnail=thumbnail)
+            if debug:
+                logger.debug(
+                    f"Frame #{process_frame_count} for session {session.id}: {frame.shape} -> {rgb_small_frame.shape} "
+                    f"({settings['profile']}), {len(face_locations)} face(s), "
+                    f"{session.last_encoding_stats['encoded']} encoded, {session.last_encoding_stats['reused']} reused"
+                )
 
             # Use the existing FaceTracker system for persistent tracking
-            match_faces_to_trackers(face_locations, current_face_encodings)
-            
-            # Build response from tracked faces (always return tracked faces, even on non-detection frames)
-            detected_faces = []
-            for tracker_id, tracker in list(face_tracker.items()):
-                if tracker.is_expired():
-                    print(f"   ❌ Tracker {tracker_id} expired, removing")
-                    del face_tracker[tracker_id]
-                    continue
-                    
-                top, right, bottom, left = tracker.location
-                
-                avg_confidence = np.mean(tracker.confidence_history) if tracker.confidence_history else 0.0
-                
-                detected_faces.append({
-                    "id": tracker_id,
-                    "name": tracker.name,
-                    "confidence": float(avg_confidence),
-                    "is_confirmed": tracker.is_confirmed,
-                    "location": {"top": int(top), "right": int(right), "bottom": int(bottom), "left": int(left)}
-                })
-                
-                print(f"   ✓ Tracker {tracker_id}: {tracker.name} (confirmed: {tracker.is_confirmed}, confidence: {avg_confidence:.3f}, missed: {tracker.missed_frames})")
-            
-            print(f"✅ Returning {len(detected_faces)} tracked faces (total active trackers: {len(face_tracker)})")
-            
-            return jsonify({
-                "status": "success",
-                "detected_faces": detected_faces,
-                "total_faces": len(detected_faces),
-                "message": f"Frame #{process_frame_count} processed with {len(detected_faces)} tracked face(s)"
-            })
-            
-        except Exception as e:
-            print(f"❌ Face processing error: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({"status": "error", "message": f"Face processing error: {str(e)}"})
-            
+            match_faces_to_trackers(session, face_locations, current_face_encodings, assignments, settings["factor"])
+        
+        # Build response from tracked faces (always return tracked faces, even on non-detection frames)
+        for tracker_id in face_tracker.remove_expired():
+            if debug:
+                logger.debug(f"Tracker {tracker_id} expired, removing")
+        detected_faces = serialize_trackers(session)
+        
+        if debug:
+            for face in detected_faces:
+                logger.debug(f"✓ Tracker {face['id']}: {face['name']} (confirmed: {face['is_confirmed']}, confidence: {face['confidence']:.3f}, missed: {face_tracker[face['id']].missed_frames})")
+        
+        return {
+            "status": "success",
+            "session_id": session.id,
+            "encoding": session.last_encoding_stats,
+            "detection": session.last_detection_stats,
+            "quality": settings,
+            "detected_faces": detected_faces,
+            "total_faces": len(detected_faces),
+            "message": f"Frame #{process_frame_count} processed with {len(detected_faces)} tracked face(s)"
+        }
+        
     except Exception as e:
-        print(f"❌ Frame processing error: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"status": "error", "message": f"Frame processing error: {str(e)}"})
+        logger.exception(f"❌ Face processing error: {e}")
+        return {"status": "error", "message": f"Face processing error: {str(e)}"}
 
-if __name__ == '__main__':
-    print("Initializing Facial Recognition Service...")
+class MediaSource:
+    """A recording to analyse: a video file or a directory of images.
+
+    Image directories are treated as consecutive samples taken at the
+    requested sample rate, in filename order.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.isdir(path):
+            self.images = sorted(f for f in os.listdir(path) if f.lower().endswith(BATCH_IMAGE_EXTENSIONS))
+            self.fps = None
+            self.frame_count = len(self.images)
+        elif os.path.isfile(path):
+            self.images = None
+            capture = cv2.VideoCapture(path)
+            if not capture.isOpened():
+                raise ValueError(f"Could not open video {path}")
+            self.fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+            self.frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            capture.release()
+        else:
+            raise ValueError(f"No such video file or image directory: {path}")
+        if self.frame_count <= 0:
+            raise ValueError(f"No frames found in {path}")
+
+    def chunks(self, sample_fps, chunk_seconds=None):
+        """Split the recording into (start_frame, end_frame) ranges of about chunk_seconds each."""
+        chunk_seconds = chunk_seconds or BATCH_CHUNK_SECONDS
+        frames_per_second = self.fps if self.images is None else sample_fps
+        chunk_frames = max(1, int(round(chunk_seconds * frames_per_second)))
+        return [(start, min(start + chunk_frames, self.frame_count)) for start in range(0, self.frame_count, chunk_frames)]
+
+def iter_media_frames(path, start_frame, end_frame, sample_fps):
+    """Yield (timestamp_seconds, frame) for sampled frames in [start_frame, end_frame).
+
+    Frames are decoded one at a time; skipped video frames are only
+    grabbed, never decoded.
+    """
+    if os.path.isdir(path):
+        images = sorted(f for f in os.listdir(path) if f.lower().endswith(BATCH_IMAGE_EXTENSIONS))
+        for index in range(start_frame, min(end_frame, len(images))):
+            frame = cv2.imread(os.path.join(path, images[index]))
+            if frame is not None:
+                yield index / sample_fps, frame
+        return
+    
+    capture = cv2.VideoCapture(path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        step = max(1, int(round(fps / sample_fps)))
+        first = start_frame + (-start_frame) % step  # Keep the sampling grid aligned across chunks
+        capture.set(cv2.CAP_PROP_POS_FRAMES, first)
+        for index in range(first, end_frame):
+            if (index - first) % step:
+                if not capture.grab():
+                    break
+                continue
+            ret, frame = capture.read()
+            if not ret:
+                break
+            yield index / fps, frame
+    finally:
+        capture.release()
+
+def _summarize_sighting(summary, name, timestamp, confidence, first_seen=None):
+    """Add one sighting; first_seen is when the tracker was first sighted, if earlier than timestamp."""
+    first_seen = timestamp if first_seen is None else first_seen
+    entry = summary.get(name)
+    if entry is None:
+        summary[name] = {"first_seen": first_seen, "last_seen": timestamp, "sightings": 1, "confidence_sum": confidence, "max_confidence": confidence}
+        return
+    entry["first_seen"] = min(entry["first_seen"], first_seen)
+    entry["last_seen"] = max(entry["last_seen"], timestamp)
+    entry["sightings"] += 1
+    entry["confidence_sum"] += confidence
+    entry["max_confidence"] = max(entry["max_confidence"], confidence)
+
+def process_media_chunk(path, start_frame, end_frame, sample_fps, quality=BATCH_QUALITY_PROFILE):
+    """Run one chunk of a recording through detect -> encode -> FaceTracker.
+
+    Only confirmed, named trackers count as sightings, but a student's
+    first_seen is the tracker's first sighting, not when it confirmed.
+    Returns a small
+    summary dict, so memory stays bounded by one decoded frame plus the
+    chunk's trackers regardless of recording length.
+    """
+    session = TrackingSession(f"batch-{start_frame}")
+    session.record_events = False
+    session.quality.set_profile(quality)
+    summary = {}
+    frames_sampled = 0
+    frames_with_unknown = 0
+    first_sighted = {}  # tracker id -> timestamp the tracker was first visible
+    for timestamp, frame in iter_media_frames(path, start_frame, end_frame, sample_fps):
+        frames_sampled += 1
+        session.frame_count += 1
+        rgb_small_frame, settings = prepare_detection_frame(session, frame)
+        face_locations, face_encodings, assignments = detect_and_identify(session, rgb_small_frame, settings)
+        match_faces_to_trackers(session, face_locations, face_encodings, assignments, settings["factor"])
+        
+        unknown_seen = False
+        store = session.face_tracker
+        rows = store.rows()
+        seen = store.missed[rows] == 0
+        confidences = store.mean_confidences(rows)
+        for tracker, visible, confirmed, confidence in zip(store.values(), seen, store.confirmed[rows], confidences):
+            # A tracker not yet recorded was created from this frame's detection (new trackers start missed)
+            first_sighted.setdefault(tracker.id, timestamp)
+            if not visible:
+                continue
+            if tracker.name == "Unknown":
+                unknown_seen = True
+            elif confirmed:
+                _summarize_sighting(summary, tracker.name, timestamp, float(confidence), first_sighted[tracker.id])
+        frames_with_unknown += unknown_seen
+    return {"students": summary, "frames_sampled": frames_sampled, "frames_with_unknown_faces": frames_with_unknown}
+
+def _init_batch_worker(encodings, names, index):
+    """Install the parent's gallery in a batch worker without rebuilding the index."""
+    global known_face_encodings, known_face_names, gallery_index, DETECTION_WORKERS
+    known_face_encodings, known_face_names, gallery_index = encodings, names, index
+    DETECTION_WORKERS = 0  # Batch workers are already the parallelism; no nested detection pool
+    logger.setLevel(logging.WARNING)
+
+def merge_chunk_summaries(chunk_results):
+    """Combine per-chunk results into per-student attendance records."""
+    students = {}
+    frames_sampled = 0
+    frames_with_unknown = 0
+    for result in chunk_results:
+        frames_sampled += result["frames_sampled"]
+        frames_with_unknown += result["frames_with_unknown_faces"]
+        for name, entry in result["students"].items():
+            merged = students.get(name)
+            if merged is None:
+                students[name] = dict(entry)
+                continue
+            merged["first_seen"] = min(merged["first_seen"], entry["first_seen"])
+            merged["last_seen"] = max(merged["last_seen"], entry["last_seen"])
+            merged["sightings"] += entry["sightings"]
+            merged["confidence_sum"] += entry["confidence_sum"]
+            merged["max_confidence"] = max(merged["max_confidence"], entry["max_confidence"])
+    
+    records = []
+    for name, entry in sorted(students.items(), key=lambda item: item[1]["first_seen"]):
+        records.append({
+            "name": name,
+            "first_seen": round(entry["first_seen"], 2),
+            "last_seen": round(entry["last_seen"], 2),
+            "sightings": entry["sightings"],
+            "mean_confidence": round(entry["confidence_sum"] / entry["sightings"], 4),
+            "max_confidence": round(entry["max_confidence"], 4),
+        })
+    return {"students": records, "frames_sampled": frames_sampled, "frames_with_unknown_faces": frames_with_unknown}
+
+def process_recording(path, sample_fps=BATCH_SAMPLE_FPS, workers=BATCH_WORKERS, quality=BATCH_QUALITY_PROFILE, progress=None):
+    """Compute attendance for a whole recording, processing chunks in parallel.
+
+    Chunks are independent, so a face that spans a chunk boundary needs to
+    be re-confirmed in the next chunk; summaries are merged by name.
+    progress(done, total) is called as chunks finish.
+    """
+    if quality not in QUALITY_PROFILES:
+        raise ValueError(f"Unknown quality profile '{quality}'")
+    source = MediaSource(path)
+    chunks = source.chunks(sample_fps)
+    started = time.perf_counter()
+    results = []
+    
+    if workers <= 1 or len(chunks) == 1:
+        for start_frame, end_frame in chunks:
+            results.append(process_media_chunk(path, start_frame, end_frame, sample_fps, quality))
+            if progress:
+                progress(len(results), len(chunks))
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=context,
+                                 initializer=_init_batch_worker, initargs=(known_face_encodings, known_face_names, gallery_index)) as executor:
+            futures = [executor.submit(process_media_chunk, path, start_frame, end_frame, sample_fps, quality) for start_frame, end_frame in chunks]
+            for future in futures:
+                results.append(future.result())
+                if progress:
+                    progress(len(results), len(chunks))
+    
+    report = merge_chunk_summaries(results)
+    report.update({
+        "source": path,
+        "sample_fps": sample_fps,
+        "chunks": len(chunks),
+        "duration_seconds": round(source.frame_count / source.fps, 2) if source.fps else round(source.frame_count / sample_fps, 2),
+        "processing_seconds": round(time.perf_counter() - started, 2),
+    })
+    return report
+
+batch_jobs = {}  # job_id -> job state dict
+batch_jobs_lock = threading.Lock()
+
+def _run_batch_job(job_id, path, sample_fps, workers, quality):
+    def progress(done, total):
+        with batch_jobs_lock:
+            batch_jobs[job_id].update(chunks_done=done, chunks_total=total)
+    try:
+        report = process_recording(path, sample_fps, workers, quality, progress)
+        with batch_jobs_lock:
+            batch_jobs[job_id].update(status="completed", result=report, finished_at=time.time())
+        logger.info(f"✅ Batch job {job_id} finished: {len(report['students'])} student(s) in {report['processing_seconds']}s")
+    except Exception as e:
+        logger.exception(f"❌ Batch job {job_id} failed: {e}")
+        with batch_jobs_lock:
+            batch_jobs[job_id].update(status="failed", message=str(e), finished_at=time.time())
+
+@app.route('/api/attendance/batch', methods=['POST'])
+def start_batch_job():
+    """Start attendance processing for a recording under BATCH_MEDIA_DIR; poll the returned job id."""
+    data = request.get_json(silent=True) or {}
+    relative_path = data.get('path')
+    if not relative_path:
+        return jsonify({"status": "error", "message": "No recording path provided"})
+    
+    media_root = os.path.realpath(BATCH_MEDIA_DIR)
+    path = os.path.realpath(os.path.join(media_root, relative_path))
+    if os.path.commonpath([media_root, path]) != media_root:
+        return jsonify({"status": "error", "message": "Recording path must be inside the batch media directory"})
+    try:
+        sample_fps = float(data.get('sample_fps', BATCH_SAMPLE_FPS))
+        workers = int(data.get('workers', BATCH_WORKERS))
+        quality = data.get('quality', BATCH_QUALITY_PROFILE)
+        if sample_fps <= 0:
+            raise ValueError("sample_fps must be positive")
+        if quality not in QUALITY_PROFILES:
+            raise ValueError(f"Unknown quality profile '{quality}'")
+        MediaSource(path)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)})
+    
+    job_id = uuid.uuid4().hex
+    with batch_jobs_lock:
+        batch_jobs[job_id] = {"job_id": job_id, "status": "running", "path": relative_path, "started_at": time.time(), "chunks_done": 0, "chunks_total": None}
+    threading.Thread(target=_run_batch_job, args=(job_id, path, sample_fps, workers, quality), name=f"batch-{job_id[:8]}", daemon=True).start()
+    return jsonify({"status": "started", "job_id": job_id})
+
+@app.route('/api/attendance/batch/<job_id>', methods=['GET'])
+def batch_job_status(job_id):
+    """Report a batch job's progress, and its attendance summary once completed."""
+    with batch_jobs_lock:
+        job = batch_jobs.get(job_id)
+        job = dict(job) if job is not None else None
+    if job is None:
+        return jsonify({"status": "error", "message": f"Unknown batch job {job_id}"}), 404
+    job["job_status"] = job.pop("status")
+    return jsonify(dict(status="success", **job))
+
+def batch_main(argv):
+    """CLI: python facial_recognition_service.py batch RECORDING [--sample-fps N] [--workers N] [--json OUT]."""
+    parser = argparse.ArgumentParser(prog="facial_recognition_service.py batch", description="Compute attendance from a recorded lecture")
+    parser.add_argument('recording', help="video file or directory of images")
+    parser.add_argument('--sample-fps', type=float, default=BATCH_SAMPLE_FPS)
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--quality', choices=list(QUALITY_PROFILES), default=BATCH_QUALITY_PROFILE)
+    parser.add_argument('--json', metavar='PATH', help="write the attendance report as JSON")
+    args = parser.parse_args(argv)
     
     if not load_reference_data():
-        print("❌ Warning: Could not load reference data. Face recognition will not work properly.")
+        logger.error("❌ Could not load reference data. Every face will be reported as unknown.")
+    report = process_recording(args.recording, args.sample_fps, args.workers, args.quality,
+                               progress=lambda done, total: logger.info(f"Processed chunk {done}/{total}"))
+    
+    print(f"{'Student':<30} {'First seen':>11} {'Last seen':>11} {'Sightings':>10} {'Confidence':>11}")
+    for record in report["students"]:
+        print(f"{record['name']:<30} {record['first_seen']:>10.1f}s {record['last_seen']:>10.1f}s {record['sightings']:>10} {record['mean_confidence']:>11.3f}")
+    print(f"{report['frames_sampled']} frame(s) sampled from {report['duration_seconds']}s in {report['processing_seconds']}s")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+        sys.exit(0)
+    
+    logger.info("Initializing Facial Recognition Service...")
+    
+    # Import dlib, load the gallery and warm the detector while the server already answers /healthz
+    start_warmup()
+    
+    if sock is None:
+        logger.warning("⚠️ flask-sock not installed: WebSocket streaming at /ws/process-frame is disabled.")
+    
+    camera_registry.refresh_in_background()
+    start_gallery_watcher()
     
-    print("Starting Flask service on port 5000...")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    port = int(os.environ.get('PORT', 5000))
+    logger.info(f"Starting Flask service on port {port}...")
+    app.run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_DEBUG') == '1')
@@ -153,6 +153,39 @@ app.get('/api/facial-recognition/camera/frame', async (req, res) => {
   }
 });
 
+// Clear face trackers for a session
+app.post('/api/facial-recognition/clear-trackers', async (req, res) => {
+  try {
+    const response = await axios.post(`${FACIAL_RECOGNITION_SERVICE_URL}/api/clear-trackers`, req.body);
+    res.json(response.data);
+  } catch (error) {
+    console.error('Error clearing trackers:', error.message);
+    res.status(500).json({ status: 'error', message: 'Failed to clear trackers' });
+  }
+});
+
+// Scope a recognition session to a course roster ({ session_id, course_id, students: [student keys] })
+app.post('/api/facial-recognition/sessions/roster', async (req, res) => {
+  try {
+    const response = await axios.post(`${FACIAL_RECOGNITION_SERVICE_URL}/api/sessions/roster`, req.body);
+    res.json(response.data);
+  } catch (error) {
+    console.error('Error setting session roster:', error.message);
+    res.status(500).json({ status: 'error', message: 'Failed to set session roster' });
+  }
+});
+
+// Attendance events emitted by the recognition service (poll with ?since=<cursor>)
+app.get('/api/facial-recognition/attendance-events', async (req, res) => {
+  try {
+    const response = await axios.get(`${FACIAL_RECOGNITION_SERVICE_URL}/api/attendance/events`, { params: req.query });
+    res.json(response.data);
+  } catch (error) {
+    console.error('Error fetching attendance events:', error.message);
+    res.status(500).json({ status: 'error', message: 'Failed to fetch attendance events' });
+  }
+});
+
 // Process frame from browser
 app.post('/api/facial-recognition/process-frame', async (req, res) => {
   try {
@@ -183,6 +216,40 @@ app.post('/api/facial-recognition/process-frame', async (req, res) => {
   }
 });
 
+// Process raw JPEG bytes from browser (no base64/JSON overhead)
+app.post('/api/facial-recognition/process-frame/raw', express.raw({ type: 'application/octet-stream', limit: '10mb' }), async (req, res) => {
+  try {
+    const response = await axios.post(`${FACIAL_RECOGNITION_SERVICE_URL}/api/process-frame/raw`, req.body, {
+      headers: {
+        'Content-Type': 'application/octet-stream',
+        'X-Session-Id': req.get('X-Session-Id') || ''
+      }
+    });
+    res.json(response.data);
+  } catch (error) {
+    console.error('Error processing raw frame:', error.message);
+    
+    let errorMessage = 'Failed to process frame';
+    let statusCode = 500;
+    
+    if (error.code === 'ECONNREFUSED') {
+      errorMessage = 'Python facial recognition service is not running. Please start it with: python facial_recognition_service.py';
+      statusCode = 503;
+    } else if (error.response) {
+      errorMessage = `Python service error: ${error.response.data?.message || error.response.statusText}`;
+      statusCode = error.response.status;
+    } else {
+      errorMessage = `Connection error: ${error.message}`;
+    }
+    
+    res.status(statusCode).json({ 
+      status: 'error', 
+      message: errorMessage,
+      details: error.code || 'unknown_error'
+    });
+  }
+});
+
 // ============================================
 // MICROSOFT GRAPH API CONFIGURATION
 // ============================================
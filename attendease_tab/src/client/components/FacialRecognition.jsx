@@ -84,6 +84,10 @@ function FacialRecognition({ onAttendanceUpdate, onMessagesUpdate }) {
   const overlayRef = useRef(null);
   const cameraActiveRef = useRef(false); // Use ref instead of state to avoid closure issues
   const processingRef = useRef(false);
+  const lastFrameSentRef = useRef(0);
+  const sendIntervalRef = useRef(100); // Adapted from the service's recommended_interval_ms
+  // Identifies this classroom's tracker state on the Python service
+  const sessionIdRef = useRef(`session_${Date.now()}_${Math.random().toString(36).substring(2, 10)}`);
   
   const [cameras, setCameras] = useState([]);
   const [selectedCamera, setSelectedCamera] = useState('');
@@ -244,7 +248,11 @@ function FacialRecognition({ onAttendanceUpdate, onMessagesUpdate }) {
     
     // Clear face trackers on the Python service
     try {
-      await fetch('/api/facial-recognition/clear-trackers', { method: 'POST' });
+      await fetch('/api/facial-recognition/clear-trackers', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ session_id: sessionIdRef.current })
+      });
       addMessage('Face trackers cleared', 'info');
     } catch (error) {
       console.error('Error clearing trackers:', error);
@@ -255,6 +263,10 @@ function FacialRecognition({ onAttendanceUpdate, onMessagesUpdate }) {
   };
 
   const processFrame = async () => {
+    if (Date.now() - lastFrameSentRef.current < sendIntervalRef.current) {
+      return;
+    }
+    
     if (!videoRef.current || !canvasRef.current || !cameraActiveRef.current || processingRef.current) {
       console.log('Frame processing skipped:', { 
         hasVideo: !!videoRef.current, 
@@ -278,15 +290,22 @@ function FacialRecognition({ onAttendanceUpdate, onMessagesUpdate }) {
       
       // Process every frame (backend handles detection/tracking logic)
       ctx.drawImage(video, 0, 0, 640, 480);
-      const imageData = canvas.toDataURL('image/jpeg', 0.8);
-      const base64Data = imageData.split(',')[1];
+      // Send raw JPEG bytes instead of base64-in-JSON (a third smaller, no parse on either end)
+      const frameBlob = await new Promise((resolve) => canvas.toBlob(resolve, 'image/jpeg', 0.8));
+      if (!frameBlob) {
+        return;
+      }
       
       console.log('Sending frame to Python service...');
+      lastFrameSentRef.current = Date.now();
       
-      const response = await fetch('/api/facial-recognition/process-frame', {
+      const response = await fetch('/api/facial-recognition/process-frame/raw', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ frame: base64Data })
+        headers: {
+          'Content-Type': 'application/octet-stream',
+          'X-Session-Id': sessionIdRef.current
+        },
+        body: frameBlob
       });
       
       if (!response.ok) {
@@ -296,7 +315,12 @@ function FacialRecognition({ onAttendanceUpdate, onMessagesUpdate }) {
       const data = await response.json();
       console.log('Python service response:', data);
       
-      if (data.status === 'success') {
+      if (data.scheduler?.recommended_interval_ms) {
+        sendIntervalRef.current = data.scheduler.recommended_interval_ms;
+      }
+      
+      // "dropped" responses still carry the current tracker state
+      if (data.status === 'success' || data.status === 'dropped') {
         const faces = data.detected_faces || [];
         setDetectedFaces(faces);
         